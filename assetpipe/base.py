@@ -3,15 +3,87 @@
 """
 import os
 import logging
+import tempfile
+import multiprocessing
+
+from collections import OrderedDict
+from multiprocessing.pool import ThreadPool
+
+from .buffers import iter_files, iter_chunks, collect
 
 try:
     import json
 except ImportError:
     from django.utils import simplejson as json
 
+#Don't let subprocesses inherit each others' pipes when they are started from
+#several threads at once, otherwise communicate() waits for the wrong process
+#to exit. Windows doesn't support close_fds with redirected pipes.
+CLOSE_FDS = os.name == "posix"
+
+
+def write_atomically(filename, chunks):
+    """ Writes the chunks to a temporary file next to filename and renames it into place,
+        so that readers only ever see the old file or the whole of the new one.
+    """
+    directory, name = os.path.split(filename)
+    fd, temp_filename = tempfile.mkstemp(prefix="." + name + ".", suffix=".tmp", dir=directory or ".")
+    try:
+        with os.fdopen(fd, "wb") as f:
+            for chunk in chunks:
+                f.write(chunk)
+        os.chmod(temp_filename, 0644)
+        os.rename(temp_filename, filename)
+    except:
+        os.remove(temp_filename)
+        raise
+
+
+def get_keep_generations(keep_generations=None):
+    """ Returns how many versions of each output file the outputters keep, including the
+        latest, given the outputter's keep_generations argument (if any).
+    """
+    from django.conf import settings
+    from .builds import background_builds_enabled
+
+    if keep_generations is None:
+        keep_generations = getattr(settings, "ASSET_KEEP_GENERATIONS", None)
+    if keep_generations is None:
+        #Background builds keep serving pages which link to the previous build until
+        #the new one has been swapped in, so it mustn't be deleted
+        keep_generations = 2 if background_builds_enabled() else 1
+    return max(1, keep_generations)
+
+
+def get_max_workers():
+    """ Returns the number of files which processors may work on concurrently. """
+    from django.conf import settings
+
+    workers = getattr(settings, "ASSET_MAX_WORKERS", None)
+    if workers is None:
+        try:
+            workers = multiprocessing.cpu_count()
+        except NotImplementedError:
+            workers = 1
+    return max(1, workers)
+
 
 class Processor(object):
 
+    #If True, the outputs of this processor are stored in the build cache
+    #(see ASSET_BUILD_CACHE_DIR). Switch this off for processors which are
+    #cheaper to run than to cache.
+    cacheable = True
+
+    #If True, the processor returns exactly one output per input, in the same
+    #order, and each output only depends on its own input. This allows the
+    #build cache to work on individual files rather than the whole stage.
+    per_file = False
+
+    #If True, the processor implements stream() rather than process(), so files can be
+    #passed through it a chunk at a time, and the next stage can start before it finishes
+    streaming = False
+
     def __init__(self, pipeline):
         """ The pipeline is passed in so that you can access it if you need to.
             The args and kwargs that you pass into .Process() when defining your
@@ -24,12 +96,93 @@ class Processor(object):
             modify them however you like (e.g. minify or concatenate them) and return
             the processed output files in the same OrderedDict format.
         """
+        if not self.streaming:
+            raise NotImplementedError()
+        return collect(self.stream(iter_files(inputs)))
+
+    def stream(self, items):
+        """ Given an iterator of (filename, chunks) pairs, where chunks is an iterable of
+            strings, yield the output files as (filename, chunks) pairs. Each file's chunks
+            can only be iterated over once, but can be consumed at any time, so it's fine
+            to look at the filenames before reading any contents.
+
+            By default this collects the inputs and calls process(); streaming processors
+            override it instead.
+        """
+        for filename, contents in self.process(collect(items)).items():
+            yield filename, iter_chunks(contents)
+
+    def process_file(self, filename, contents):
+        """ Process a single input, returning an (output_filename, StringIO(output)) tuple.
+            Only used by per_file processors which call process_files() from process().
+        """
         raise NotImplementedError()
 
+    def process_files(self, inputs):
+        """ Calls process_file() for each of the inputs on a pool of up to ASSET_MAX_WORKERS
+            threads, and returns the outputs in the same order as the inputs. If any of the
+            files fail, a ValueError listing all of the failures is raised.
+        """
+        items = inputs.items()
+
+        def run(item):
+            filename, contents = item
+            try:
+                return self.process_file(filename, contents), None
+            except Exception, e:
+                logging.exception("Failed to process %s", filename)
+                return None, e
+
+        workers = min(get_max_workers(), len(items))
+        if workers > 1:
+            pool = ThreadPool(workers)
+            try:
+                results = pool.map(run, items)
+            finally:
+                pool.close()
+                pool.join()
+        else:
+            results = map(run, items)
+
+        errors = []
+        outputs = OrderedDict()
+        for (filename, contents), (output, error) in zip(items, results):
+            if error is not None:
+                errors.append("%s: %s" % (filename, error))
+            else:
+                outputs[output[0]] = output[1]
+
+        if errors:
+            raise ValueError("Failed to process %d file(s):\n%s" % (len(errors), "\n".join(errors)))
+
+        return outputs
+
     def prepare(self, inputs):
         return inputs
 
+    def get_cache_key_parts(self):
+        """ Return a list of strings describing any configuration (e.g. settings)
+            which affects the output, other than the args passed to .Process().
+        """
+        return []
+
+    def get_dependencies(self, filenames):
+        """ Return a list of paths to any files, other than the inputs themselves, which
+            are read when processing the given input filenames (e.g. imported files).
+            The pipeline is rebuilt whenever one of them changes.
+        """
+        return []
+
+    def get_cache_dependencies(self, filenames):
+        """ Return a list of paths to any files, other than the inputs themselves,
+            which are read when processing the given input filenames. The contents
+            of these files are included in the build cache key.
+        """
+        return self.get_dependencies(filenames)
+
 class NullProcessor(Processor):
+    cacheable = False
+
     def process(self, inputs):
         logging.warning("Using a NullProcessor, your pipeline is likely outdated")
         return inputs
@@ -42,6 +195,13 @@ class Outputter(object):
     def output(self, filename, file_out):
         raise NotImplementedError()
 
+    def output_files(self, items):
+        """ Outputs each of the (filename, file_out) pairs. Override this to write
+            them concurrently.
+        """
+        for filename, file_out in items:
+            self.output(filename, file_out)
+
     def get_output_filename(self, filename):
         if self.strip_path and filename.startswith(self.strip_path):
             filename = filename[len(self.strip_path) + 1:]
@@ -62,7 +222,7 @@ class NullOutputter(object):
         return filename in self.cache
 
 
-def read_generated_media_file(active_pipeline=None):
+def get_generated_media_filename(active_pipeline=None):
     from django.conf import settings
 
     filename = settings.ASSET_MEDIA_URLS_FILE
@@ -70,22 +230,27 @@ def read_generated_media_file(active_pipeline=None):
 
     #Make the filename active pipeline specific
     path, ext = os.path.splitext(filename)
-    filename = ".".join([path, active_pipeline.lower(), ext.lstrip(".")])
+    return ".".join([path, active_pipeline.lower(), ext.lstrip(".")])
+
+def read_generated_media_file(active_pipeline=None):
+    filename = get_generated_media_filename(active_pipeline)
     return json.loads(open(filename).read())
 
-def build_generated_media_file(active_pipeline=None):
+def build_generated_media_file(active_pipeline=None, urls=None):
+    """ Writes the manifest of bundle_name: output_urls for the pipeline. If the urls
+        have already been collected (e.g. from worker processes) they can be passed in.
+    """
     from django.conf import settings
 
-    filename = settings.ASSET_MEDIA_URLS_FILE
     active_pipeline = active_pipeline or settings.ASSET_PIPELINE_ACTIVE
+    filename = get_generated_media_filename(active_pipeline)
 
-    #Make the filename active pipeline specific
-    path, ext = os.path.splitext(filename)
-    filename = ".".join([path, active_pipeline.lower(), ext.lstrip(".")])
-
-    final = {}
-    for k, v in settings.ASSET_PIPELINES[active_pipeline].items():
-        final[k] = v.output_urls()
+    if urls is not None:
+        final = dict(urls)
+    else:
+        final = {}
+        for k, v in settings.ASSET_PIPELINES[active_pipeline].items():
+            final[k] = v.output_urls()
 
-    with open(filename, "w") as f:
-        f.write(json.dumps(final))
+    #The manifest may be read by running servers (see ASSET_MANIFEST_CHECK_INTERVAL)
+    write_atomically(filename, [json.dumps(final)])
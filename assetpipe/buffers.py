@@ -0,0 +1,134 @@
+""" File-like objects which let pipeline stages pass file contents along without copying them.
+
+    Gather hands out FileBuffers, which don't read anything until they are consumed, and
+    the concatenating processors return ChainBuffers, which refer to their parts rather than
+    copying them. Outputters write them out with iter_chunks(), so a bundle of large vendor
+    files never has to be in memory all at once. Both still support read() and seek(0), so
+    processors which expect a StringIO keep working.
+"""
+from collections import OrderedDict
+
+CHUNK_SIZE = 64 * 1024
+
+
+def iter_chunks(contents, size=CHUNK_SIZE):
+    """ Yields the whole of contents (a buffer, file-like object or string) in chunks of
+        roughly size bytes.
+    """
+    if isinstance(contents, basestring):
+        if contents:
+            yield contents
+        return
+
+    if hasattr(contents, "chunks"):
+        for chunk in contents.chunks(size):
+            yield chunk
+        return
+
+    contents.seek(0)
+    while True:
+        chunk = contents.read(size)
+        if not chunk:
+            break
+        yield chunk
+
+
+class Buffer(object):
+    """ Base class for buffers, which only need to implement chunks(). """
+
+    def __init__(self):
+        self._chunks = None #The chunks which read() is working through
+        self._pending = "" #Part of a chunk which read() hasn't returned yet
+
+    def chunks(self, size=CHUNK_SIZE):
+        """ Returns an iterator over the contents, starting from the beginning each time. """
+        raise NotImplementedError()
+
+    def seek(self, offset, whence=0):
+        if offset or whence:
+            raise IOError("%s can only be rewound to the beginning" % self.__class__.__name__)
+        self._chunks = None
+        self._pending = ""
+
+    def read(self, size=-1):
+        if self._chunks is None:
+            self._chunks = self.chunks()
+
+        if size is None or size < 0:
+            result = self._pending + "".join(self._chunks)
+            self._pending = ""
+            return result
+
+        parts = [self._pending]
+        length = len(self._pending)
+        for chunk in self._chunks:
+            parts.append(chunk)
+            length += len(chunk)
+            if length >= size:
+                break
+
+        data = "".join(parts)
+        self._pending = data[size:]
+        return data[:size]
+
+    def getvalue(self):
+        return "".join(self.chunks())
+
+
+class FileBuffer(Buffer):
+    """ The contents of a file, which isn't opened until it is read. """
+
+    def __init__(self, path):
+        super(FileBuffer, self).__init__()
+        self.path = path
+
+    def chunks(self, size=CHUNK_SIZE):
+        with open(self.path, "r") as f:
+            while True:
+                chunk = f.read(size)
+                if not chunk:
+                    break
+                yield chunk
+
+
+class ChainBuffer(Buffer):
+    """ The concatenation of a list of buffers, file-like objects and strings. """
+
+    def __init__(self, parts):
+        super(ChainBuffer, self).__init__()
+        self.parts = list(parts)
+
+    def chunks(self, size=CHUNK_SIZE):
+        for part in self.parts:
+            for chunk in iter_chunks(part, size):
+                yield chunk
+
+
+class IterBuffer(Buffer):
+    """ Contents which come from an iterator of chunks, so can only be read once. """
+
+    def __init__(self, chunks):
+        super(IterBuffer, self).__init__()
+        self._source = iter(chunks)
+
+    def chunks(self, size=CHUNK_SIZE):
+        if self._source is None:
+            raise IOError("IterBuffer can only be read once")
+        source, self._source = self._source, None
+        return source
+
+
+def iter_files(files):
+    """ Converts an OrderedDict of filename: file_like_object into the (filename, chunks)
+        pairs used by Processor.stream().
+    """
+    for filename, contents in files.items():
+        yield filename, iter_chunks(contents)
+
+
+def collect(items):
+    """ Converts (filename, chunks) pairs back into an OrderedDict of filename: buffer. """
+    outputs = OrderedDict()
+    for filename, chunks in items:
+        outputs[filename] = ChainBuffer(list(chunks))
+    return outputs
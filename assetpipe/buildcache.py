@@ -0,0 +1,260 @@
+""" A persistent, content-addressed cache of processor outputs.
+
+    Entries are keyed by a hash of the processor (class, constructor args and
+    any configuration it reports), the bytes of its inputs and the bytes of any
+    additional files it depends on. A hit means the processor does not need to
+    be run at all, so no Ruby/JVM processes get spawned for unchanged files.
+"""
+import os
+import time
+import errno
+import logging
+import tempfile
+import cPickle as pickle
+
+from hashlib import md5
+
+from django.utils.encoding import smart_str
+
+
+DEFAULT_MAX_SIZE = 100 * 1024 * 1024 #100MB
+DEFAULT_MAX_AGE = 60 * 60 * 24 * 30 #30 days
+DEFAULT_PRUNE_INTERVAL = 60
+
+
+class BuildCache(object):
+    def __init__(self, directory, max_size=DEFAULT_MAX_SIZE, max_age=DEFAULT_MAX_AGE, prune_interval=DEFAULT_PRUNE_INTERVAL):
+        self.directory = directory
+        self.max_size = max_size
+        self.max_age = max_age
+        self.prune_interval = prune_interval
+
+        #Pruning walks the whole directory, so maybe_prune() only does it when
+        #something has been written, and at most once every prune_interval seconds
+        self._last_prune = None
+        self._writes = 0
+
+        #path: (mtime, size, digest) so that dependencies shared by many
+        #inputs are only read once per change
+        self._file_digests = {}
+
+    def make_key(self, *parts):
+        hasher = md5()
+        for part in parts:
+            part = smart_str(part)
+            #Length prefix each part so that ("ab", "c") and ("a", "bc") differ
+            hasher.update("%d:" % len(part))
+            hasher.update(part)
+        return hasher.hexdigest()
+
+    def file_digest(self, path):
+        """ Returns a digest of the contents of the file at path, or an empty
+            string if the file doesn't exist.
+        """
+        try:
+            stat = os.stat(path)
+        except OSError:
+            return ""
+
+        cached = self._file_digests.get(path)
+        if cached and cached[:2] == (stat.st_mtime, stat.st_size):
+            return cached[2]
+
+        hasher = md5()
+        with open(path, "rb") as f:
+            for chunk in iter(lambda: f.read(64 * 1024), ""):
+                hasher.update(chunk)
+
+        digest = hasher.hexdigest()
+        self._file_digests[path] = (stat.st_mtime, stat.st_size, digest)
+        return digest
+
+    def _path(self, key):
+        return os.path.join(self.directory, key[:2], key)
+
+    def get(self, key):
+        """ Returns the list of (filename, content) pairs stored under key, or
+            None if there is no (unexpired) entry.
+        """
+        path = self._path(key)
+        try:
+            if self.max_age and time.time() - os.path.getmtime(path) > self.max_age:
+                os.remove(path)
+                return None
+
+            with open(path, "rb") as f:
+                result = pickle.load(f)
+        except (IOError, OSError):
+            return None
+        except Exception, e:
+            #A corrupt entry is just a miss
+            logging.warn("Discarding unreadable build cache entry %s: %s", path, e)
+            self._remove(path)
+            return None
+
+        #Bump the mtime, eviction is least-recently-used
+        try:
+            os.utime(path, None)
+        except OSError:
+            pass
+
+        return result
+
+    def set(self, key, outputs):
+        """ Stores a list of (filename, content) pairs under key. """
+        path = self._path(key)
+        directory = os.path.dirname(path)
+
+        try:
+            os.makedirs(directory)
+        except OSError, e:
+            if e.errno != errno.EEXIST:
+                raise
+
+        #Write to a temporary file and rename, so concurrent readers never
+        #see a partially written entry
+        fd, tmp_path = tempfile.mkstemp(dir=directory)
+        try:
+            with os.fdopen(fd, "wb") as f:
+                pickle.dump(list(outputs), f, pickle.HIGHEST_PROTOCOL)
+            os.rename(tmp_path, path)
+        except:
+            self._remove(tmp_path)
+            raise
+
+        self._writes += 1
+
+    def maybe_prune(self):
+        """ Prunes the cache if anything has been written to it since the last prune,
+            and it wasn't pruned in the last prune_interval seconds.
+        """
+        if not self._writes:
+            return
+
+        if self._last_prune is not None and time.time() - self._last_prune < self.prune_interval:
+            return
+
+        self.prune()
+
+    def prune(self):
+        """ Removes expired entries, then the least recently used ones until the
+            cache is no bigger than max_size.
+        """
+        now = time.time()
+        self._last_prune = now
+        self._writes = 0
+
+        if not os.path.exists(self.directory):
+            return
+
+        entries = []
+        total_size = 0
+
+        for root, dirnames, filenames in os.walk(self.directory):
+            for filename in filenames:
+                path = os.path.join(root, filename)
+                try:
+                    stat = os.stat(path)
+                except OSError:
+                    continue
+
+                if self.max_age and now - stat.st_mtime > self.max_age:
+                    self._remove(path)
+                    continue
+
+                entries.append((stat.st_mtime, stat.st_size, path))
+                total_size += stat.st_size
+
+        if not self.max_size or total_size <= self.max_size:
+            return
+
+        for mtime, size, path in sorted(entries):
+            if total_size <= self.max_size:
+                break
+            logging.debug("Evicting build cache entry %s", path)
+            self._remove(path)
+            total_size -= size
+
+    def _remove(self, path):
+        try:
+            os.remove(path)
+        except OSError:
+            pass
+
+
+class MemoryBuildCache(BuildCache):
+    """ Keeps the entries used by the most recent run of a node in memory, in front
+        of an optional on-disk BuildCache. Used for incremental builds, so that only
+        the files which have changed since the last run get processed again.
+    """
+    def __init__(self, backend=None):
+        super(MemoryBuildCache, self).__init__(None, max_size=None, max_age=None)
+        self.backend = backend
+        self._entries = {}
+        self._used = set()
+
+    def file_digest(self, path):
+        if self.backend:
+            return self.backend.file_digest(path)
+        return super(MemoryBuildCache, self).file_digest(path)
+
+    def get(self, key):
+        result = self._entries.get(key)
+        if result is None and self.backend:
+            result = self.backend.get(key)
+            if result is not None:
+                self._entries[key] = result
+
+        if result is not None:
+            self._used.add(key)
+        return result
+
+    def set(self, key, outputs):
+        outputs = list(outputs)
+        self._entries[key] = outputs
+        self._used.add(key)
+        if self.backend:
+            self.backend.set(key, outputs)
+
+    def _forget_unused(self):
+        """ Forgets anything which wasn't used since the last prune. """
+        for key in set(self._entries.keys()) - self._used:
+            del self._entries[key]
+        self._used = set()
+
+    def maybe_prune(self):
+        self._forget_unused()
+        if self.backend:
+            self.backend.maybe_prune()
+
+    def prune(self):
+        self._forget_unused()
+        if self.backend:
+            self.backend.prune()
+
+
+def incremental_builds_enabled():
+    from django.conf import settings
+    return getattr(settings, "ASSET_INCREMENTAL_BUILDS", False)
+
+
+_build_caches = {}
+
+def get_build_cache():
+    """ Returns the BuildCache configured by the ASSET_BUILD_CACHE_* settings,
+        or None if ASSET_BUILD_CACHE_DIR isn't set.
+    """
+    from django.conf import settings
+
+    directory = getattr(settings, "ASSET_BUILD_CACHE_DIR", None)
+    if not directory:
+        return None
+
+    max_size = getattr(settings, "ASSET_BUILD_CACHE_MAX_SIZE", DEFAULT_MAX_SIZE)
+    max_age = getattr(settings, "ASSET_BUILD_CACHE_MAX_AGE", DEFAULT_MAX_AGE)
+    prune_interval = getattr(settings, "ASSET_BUILD_CACHE_PRUNE_INTERVAL", DEFAULT_PRUNE_INTERVAL)
+
+    cache_id = (directory, max_size, max_age, prune_interval)
+    if cache_id not in _build_caches:
+        _build_caches[cache_id] = BuildCache(directory, max_size, max_age, prune_interval)
+    return _build_caches[cache_id]
@@ -0,0 +1,230 @@
+""" Keeps pipelines up to date while developing (ASSET_DEV_MODE), for the middleware
+    and the template tags.
+
+    With ASSET_BACKGROUND_BUILDS, a bundle which has been built once is rebuilt on a
+    background thread, and the URLs of the last successful build are used until the new
+    build has finished, so requests don't wait for the compilers.
+
+    Only one thread builds a bundle at a time; others wait for its build rather than
+    starting their own. ASSET_BUILD_LOCK_DIR extends this to other processes.
+
+    When a build fails, its error is remembered along with the hash of the bundle's
+    inputs, and raised again without rebuilding until one of the inputs changes.
+"""
+import os
+import sys
+import logging
+import threading
+
+from contextlib import contextmanager
+from hashlib import md5
+
+try:
+    import fcntl
+    HAVE_FCNTL = True
+except ImportError:
+    HAVE_FCNTL = False
+
+from . import gae_sandbox
+from .watcher import get_watcher
+
+BUILDING = "building"
+FAILED = "failed"
+READY = "ready"
+
+
+class BuildState(object):
+    def __init__(self):
+        self.lock = threading.Lock()
+        self.urls = None #The output URLs of the last successful build
+        self.building = False
+        self.error = None
+
+        #Held while the bundle is being checked or built
+        self.build_lock = threading.Lock()
+        #Incremented after each successful run, so that threads which were waiting for
+        #the lock can tell that the bundle has been brought up to date in the meantime
+        self.generation = 0
+
+        #(input hash, exc_info) of the last build, if it failed
+        self.failure = None
+
+    @property
+    def status(self):
+        if self.building:
+            return BUILDING
+        if self.error is not None:
+            return FAILED
+        return READY
+
+
+#pipeline head: BuildState
+_states = {}
+_states_lock = threading.Lock()
+
+
+def background_builds_enabled():
+    from django.conf import settings
+    return getattr(settings, "ASSET_BACKGROUND_BUILDS", False)
+
+
+def get_build_state(pipeline):
+    with _states_lock:
+        return _states.setdefault(pipeline.head, BuildState())
+
+
+def build_status():
+    """ Returns BUILDING if any bundle is being rebuilt, FAILED if the last build of any
+        bundle failed, otherwise READY.
+    """
+    with _states_lock:
+        statuses = set(state.status for state in _states.values())
+
+    for status in (BUILDING, FAILED):
+        if status in statuses:
+            return status
+    return READY
+
+
+@contextmanager
+def _file_lock(pipeline):
+    """ Holds an exclusive lock on a file in ASSET_BUILD_LOCK_DIR for the bundle, so that
+        processes sharing STATIC_ROOT don't build it at the same time. Does nothing if the
+        setting isn't set or file locking isn't available.
+    """
+    from django.conf import settings
+
+    directory = getattr(settings, "ASSET_BUILD_LOCK_DIR", None)
+    if not directory or not HAVE_FCNTL:
+        yield
+        return
+
+    #Bundles are different objects in each process, so identify them by what they serve and read
+    head = pipeline.head
+    key = md5("\0".join([head.url_root] + list(head.input_files))).hexdigest()
+
+    if not os.path.exists(directory):
+        try:
+            os.makedirs(directory)
+        except OSError:
+            if not os.path.isdir(directory):
+                raise
+
+    with open(os.path.join(directory, key + ".lock"), "a") as f:
+        fcntl.flock(f.fileno(), fcntl.LOCK_EX)
+        try:
+            yield
+        finally:
+            fcntl.flock(f.fileno(), fcntl.LOCK_UN)
+
+
+def _raise_if_failed(pipeline, state, watcher):
+    """ Raises the error from the last build again if it failed and none of the
+        bundle's inputs have changed since. With a watcher, the inputs are only
+        checked once it has seen a change.
+    """
+    if state.failure is None:
+        return
+
+    failed_hash, exc_info = state.failure
+    head = pipeline.head
+    if watcher:
+        if not watcher.is_dirty(head):
+            raise exc_info[0], exc_info[1], exc_info[2]
+
+        #Clear the flag before checking, so that anything which changes after this is still seen
+        watcher.clear(head)
+
+    head.prepare()
+    if head.hash == failed_hash:
+        raise exc_info[0], exc_info[1], exc_info[2]
+
+    if watcher:
+        watcher.mark_dirty(head)
+
+
+def _run(pipeline):
+    """ Runs the pipeline if it's out of date, using the watcher (if enabled) to avoid
+        checking the files when nothing has changed. If another thread is already running
+        it, waits for that to finish instead. Returns the output URLs.
+    """
+    state = get_build_state(pipeline)
+    generation = state.generation
+
+    with state.build_lock:
+        if state.generation == generation:
+            with _file_lock(pipeline):
+                watcher = get_watcher()
+                _raise_if_failed(pipeline, state, watcher)
+                try:
+                    if watcher:
+                        watcher.run(pipeline)
+                    else:
+                        pipeline.run()
+                except Exception:
+                    state.failure = (getattr(pipeline.head, "hash", None), sys.exc_info())
+                    raise
+                state.failure = None
+            state.generation += 1
+        #Otherwise, someone else brought it up to date while we were waiting
+
+        #Running the pipeline changes its hash, so the URLs have to be read under the lock
+        return pipeline.output_urls()
+
+
+@gae_sandbox.allow_modules
+def _build_in_background(pipeline, state):
+    #This runs after the request which started it has returned, so it needs
+    #its own allow_modules for the compilers to run in the App Engine SDK
+    try:
+        urls = _run(pipeline)
+    except Exception, e:
+        if e is not state.error:
+            #Unchanged inputs raise the same error again, which has already been logged
+            logging.exception("Background build failed, serving the previous build")
+        with state.lock:
+            state.error = e
+            state.building = False
+    else:
+        #Switch over to the new outputs in one go
+        with state.lock:
+            state.urls = urls
+            state.error = None
+            state.building = False
+
+
+@gae_sandbox.allow_modules
+def run_pipeline(pipeline):
+    """ Brings the pipeline up to date and returns its output URLs. With background builds,
+        this returns the URLs of the last successful build straight away, and starts a
+        rebuild if one isn't already running.
+
+        The compilers run in subprocesses, which the App Engine SDK only allows inside
+        gae_sandbox.allow_modules, so this is wrapped in it for the template tags as well
+        as the middleware.
+    """
+    if not background_builds_enabled():
+        return _run(pipeline)
+
+    state = get_build_state(pipeline)
+    with state.lock:
+        if state.urls is not None:
+            if state.building:
+                return state.urls
+
+            watcher = get_watcher()
+            if watcher and not watcher.is_dirty(pipeline.head):
+                return state.urls
+
+            state.building = True
+            thread = threading.Thread(target=_build_in_background, args=(pipeline, state))
+            thread.daemon = True
+            thread.start()
+            return state.urls
+
+    #There's nothing to serve until the first build has finished, so it has to be done now
+    urls = _run(pipeline)
+    with state.lock:
+        state.urls = urls
+        state.error = None
+    return urls
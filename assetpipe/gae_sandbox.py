@@ -1,6 +1,7 @@
 """ Utilities for allowing assetpipe to work in the Google App Engine SDK. """
 
 import contextlib
+import threading
 try:
     from google.appengine.tools.devappserver2.python import stubs
     ON_GAE = True
@@ -9,6 +10,9 @@ except ImportError:
 
 
 if ON_GAE:
+    #Whether the current thread is already inside allow_modules
+    _local = threading.local()
+
     def allow_modules(func):
         """
             A decorator for allowing modules that are usually disallowed by App Engine.
@@ -16,9 +20,13 @@ if ON_GAE:
             use the internal ones instead of system ones, this wrapper reloads the
             modules and patches the google internal ones with the __dict__ from the
             system modules, this seems to be the cleanest way to do this even though
-            it is a bit hacky
+            it is a bit hacky. Calls from inside another allow_modules call are
+            left alone.
         """
         def _wrapped(*args, **kwargs):
+            if getattr(_local, "active", False):
+                return func(*args, **kwargs)
+
             import sys
 
             import subprocess
@@ -41,9 +49,11 @@ if ON_GAE:
             # We have to maintain the environment, or bad things happen
             os.environ = environ
 
+            _local.active = True
             try:
                 return func(*args, **kwargs)
             finally:
+                _local.active = False
                 # Restore the original path
                 sys.meta_path = old_meta_path
                 # Reload the original modules
@@ -1,13 +1,223 @@
-
 import os
 import re
+import fnmatch
+
+try:
+    from os import scandir
+except ImportError:
+    try:
+        #The backport of os.scandir for Python 2
+        from scandir import scandir
+    except ImportError:
+        scandir = None
+
+
+WILDCARD = re.compile(r"[*?[]")
+
+#pathname: (root, [component, ...]), components are either "**" or a tuple of
+#(compiled regex, whether it can match hidden files)
+_pattern_cache = {}
+
 
 def touch(fname, times=None):
     with file(fname, 'a'):
         os.utime(fname, times)
 
+
+def has_wildcards(pathname):
+    return WILDCARD.search(pathname) is not None
+
+
+def compile_pattern(pathname):
+    """ Splits pathname into the directory to start walking from, and the list of
+        components which the rest of the path has to match. Results are cached.
+    """
+    try:
+        return _pattern_cache[pathname]
+    except KeyError:
+        pass
+
+    parts = pathname.replace("\\", "/").split("/")
+
+    root = []
+    while len(parts) > 1 and not has_wildcards(parts[0]):
+        root.append(parts.pop(0))
+
+    components = []
+    for part in parts:
+        if part == "**":
+            #**/** is the same as **
+            if not components or components[-1] != "**":
+                components.append(part)
+        else:
+            components.append((re.compile(fnmatch.translate(part)), part.startswith(".")))
+
+    if pathname.startswith("/"):
+        root = "/" + "/".join(root[1:])
+    else:
+        root = "/".join(root)
+
+    result = (root or ".", components)
+    _pattern_cache[pathname] = result
+    return result
+
+
+def _expand(components, states):
+    """ A ** can match zero directories, so a state at a ** is also at the component after it. """
+    result = set(states)
+    for i in states:
+        while i < len(components) and components[i] == "**":
+            i += 1
+            result.add(i)
+    return result
+
+
+def _matches(component, name):
+    regex, match_hidden = component
+    #Like the standard glob, wildcards don't match hidden files
+    if name.startswith(".") and not match_hidden:
+        return False
+    return regex.match(name) is not None
+
+
+def _advance(components, states, name):
+    """ Returns the states reached after descending into a directory called name. """
+    result = set()
+    for i in _expand(components, states):
+        if i >= len(components) - 1:
+            #The last component has to match a file, except for a trailing **
+            if i == len(components) - 1 and components[i] == "**" and not name.startswith("."):
+                result.add(i)
+            continue
+
+        component = components[i]
+        if component == "**":
+            if not name.startswith("."):
+                result.add(i)
+        elif _matches(component, name):
+            result.add(i + 1)
+    return frozenset(result)
+
+
+def _file_components(components, states):
+    """ Returns the components which a file name has to match, given the states of its directory. """
+    return [ components[i] for i in _expand(components, states) if i == len(components) - 1 ]
+
+
+def _file_matches(file_components, name):
+    for component in file_components:
+        if component == "**":
+            if not name.startswith("."):
+                return True
+        elif _matches(component, name):
+            return True
+    return False
+
+
+def _list_directory(directory):
+    """ Returns sorted lists of the (subdirectory names, file names) in directory. """
+    dirnames = []
+    filenames = []
+
+    try:
+        if scandir is not None:
+            for entry in scandir(directory):
+                (dirnames if entry.is_dir() else filenames).append(entry.name)
+        else:
+            for name in os.listdir(directory):
+                (dirnames if os.path.isdir(os.path.join(directory, name)) else filenames).append(name)
+    except OSError:
+        return [], []
+
+    dirnames.sort()
+    filenames.sort()
+    return dirnames, filenames
+
+
+def _walk(root, patterns, results):
+    """ Walks the tree under root once, matching every file against all of the patterns.
+        Directories which none of the patterns could match anything in are not entered.
+    """
+    initial = tuple(frozenset([0]) for pattern in patterns)
+    to_visit = [ (root, initial) ]
+
+    #Most directories in a tree are in the same state, so only work out what
+    #their files have to match, and what their subdirectories can match, once
+    file_components_cache = {}
+    advance_cache = {}
+
+    while to_visit:
+        directory, states = to_visit.pop()
+        dirnames, filenames = _list_directory(directory)
+
+        for index, pattern_states in enumerate(states):
+            if not pattern_states:
+                continue
+
+            pathname, components = patterns[index]
+            key = (index, pattern_states)
+            file_components = file_components_cache.get(key)
+            if file_components is None:
+                file_components = file_components_cache[key] = _file_components(components, pattern_states)
+
+            if not file_components:
+                continue
+
+            for filename in filenames:
+                if _file_matches(file_components, filename):
+                    results[pathname].append(
+                        filename if directory == "." else os.path.join(directory, filename)
+                    )
+
+        subdirectories = []
+        for dirname in dirnames:
+            new_states = []
+            for index, pattern_states in enumerate(states):
+                if not pattern_states:
+                    new_states.append(pattern_states)
+                    continue
+
+                key = (index, pattern_states, dirname)
+                advanced = advance_cache.get(key)
+                if advanced is None:
+                    advanced = advance_cache[key] = _advance(patterns[index][1], pattern_states, dirname)
+                new_states.append(advanced)
+
+            if any(new_states):
+                path = dirname if directory == "." else os.path.join(directory, dirname)
+                subdirectories.append((path, tuple(new_states)))
+
+        #Visit in order, files in a directory before its subdirectories
+        to_visit.extend(reversed(subdirectories))
+
+
+def glob_many(pathnames):
+    """ Returns a dictionary of pathname: [matching files] for each of the pathnames.
+        Patterns which share a root directory are matched in a single walk of it.
+    """
+    results = dict((pathname, []) for pathname in pathnames)
+
+    by_root = {}
+    for pathname in results.keys():
+        if not has_wildcards(pathname):
+            if os.path.isfile(pathname):
+                results[pathname].append(pathname)
+            continue
+
+        root, components = compile_pattern(pathname)
+        by_root.setdefault(root, []).append((pathname, components))
+
+    for root, patterns in by_root.items():
+        _walk(root, patterns, results)
+
+    return results
+
+
 def glob(pathname):
     """
+    Matches files using the same wildcards as the standard glob module, plus ** which matches any
+    number of directories (including none).
+
     >>> import os
     >>> try:
     ...     os.makedirs("/tmp/globber/1/2/3")
@@ -20,6 +230,8 @@ def glob(pathname):
     >>> touch("/tmp/globber/1/2/3/a.py")
     >>> touch("/tmp/globber/1/2/3/b.txt")
     >>> touch("/tmp/globber/1/2/3/b a.csv")
+    >>> touch("/tmp/globber/1/2/3/jquery.min.js")
+    >>> touch("/tmp/globber/1/2/3/a.pyc")
     >>> glob("/tmp/globber/*.py")
     ['/tmp/globber/a.py']
     >>> glob("/tmp/globber/**/*.py")
@@ -28,27 +240,14 @@ def glob(pathname):
     ['/tmp/globber/1/2/a.py', '/tmp/globber/1/2/3/a.py']
     >>> glob("/tmp/globber/**/2/**/*.csv")
     ['/tmp/globber/1/2/3/b a.csv']
+    >>> glob("/tmp/globber/1/*/3/*.js")
+    ['/tmp/globber/1/2/3/jquery.min.js']
+    >>> glob("/tmp/globber/1/2/a.py")
+    ['/tmp/globber/1/2/a.py']
     """
-
-    results = []
-
-    root = os.path.dirname(pathname).split("**")[0]
-    regex = re.escape(pathname)
-
-    regex = regex.replace("\\*\\*\\/\\*", "([a-zA-Z0-9_-|\\/|\s]+)")
-    regex = regex.replace("\\*\\*", "([a-zA-Z0-9_-|\\/|\s]+)")
-    regex = regex.replace("\\*", "([a-zA-Z0-9_-]+)")
-
-    for root, dirnames, filenames in os.walk(top=root, followlinks=True):
-        for f in filenames:
-            full_path = os.path.join(root, f)
-            if re.match(regex, full_path):
-                results.append(full_path)
-
-    return results
+    return glob_many([pathname])[pathname]
 
 
 if __name__ == '__main__':
     import doctest
     doctest.testmod()
-
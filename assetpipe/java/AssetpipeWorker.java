@@ -0,0 +1,221 @@
+import java.io.BufferedInputStream;
+import java.io.BufferedOutputStream;
+import java.io.ByteArrayInputStream;
+import java.io.ByteArrayOutputStream;
+import java.io.FileDescriptor;
+import java.io.FileInputStream;
+import java.io.FileOutputStream;
+import java.io.IOException;
+import java.io.InputStream;
+import java.io.OutputStream;
+import java.io.PrintStream;
+import java.lang.reflect.InvocationTargetException;
+import java.lang.reflect.Method;
+import java.security.Permission;
+import java.util.ArrayList;
+import java.util.List;
+
+/**
+ * The worker side of assetpipe's compiler worker protocol (see assetpipe/workers.py) for
+ * compilers which run on the JVM, such as YUI Compressor and Closure Compiler.
+ *
+ * For each request, the main method of the class named on the command line is called with
+ * the request's arguments, the input as System.in, and System.out and System.err captured
+ * for the response. Calls to System.exit() are turned into the response's exit status by
+ * a SecurityManager, so one JVM serves every request. For example:
+ *
+ *   java -Djava.security.manager=allow -cp yuicompressor.jar AssetpipeWorker.java com.yahoo.platform.yui.compressor.YUICompressor
+ *
+ * -Djava.security.manager=allow is needed on Java 18 and later (and isn't accepted before
+ * Java 12). Java 24 disabled the SecurityManager entirely, so this needs Java 23 or earlier.
+ */
+public class AssetpipeWorker {
+
+    static class ExitException extends SecurityException {
+        final int status;
+
+        ExitException(int status) {
+            super("System.exit(" + status + ")");
+            this.status = status;
+        }
+    }
+
+    static class ExitSecurityManager extends SecurityManager {
+        @Override
+        public void checkPermission(Permission permission) {
+        }
+
+        @Override
+        public void checkPermission(Permission permission, Object context) {
+        }
+
+        @Override
+        public void checkExit(int status) {
+            throw new ExitException(status);
+        }
+    }
+
+    public static void main(String[] args) throws Exception {
+        if (args.length != 1) {
+            System.err.println("Usage: AssetpipeWorker <main class>");
+            System.exit(2);
+        }
+
+        Method main = Class.forName(args[0]).getMethod("main", String[].class);
+
+        //The protocol uses the real stdin and stdout, whatever the compiler does with System.in/out
+        InputStream in = new BufferedInputStream(new FileInputStream(FileDescriptor.in));
+        OutputStream out = new BufferedOutputStream(new FileOutputStream(FileDescriptor.out));
+
+        System.setSecurityManager(new ExitSecurityManager());
+
+        while (true) {
+            byte[] arguments = readFrame(in);
+            byte[] input = arguments == null ? null : readFrame(in);
+            if (input == null) {
+                break;
+            }
+
+            ByteArrayOutputStream output = new ByteArrayOutputStream();
+            ByteArrayOutputStream errors = new ByteArrayOutputStream();
+            int status = run(main, parseArguments(new String(arguments, "UTF-8")), input, output, errors);
+
+            writeFrame(out, Integer.toString(status).getBytes("US-ASCII"));
+            writeFrame(out, output.toByteArray());
+            writeFrame(out, errors.toByteArray());
+            out.flush();
+        }
+
+        //stdin was closed, System.exit() would be caught by our own SecurityManager
+        Runtime.getRuntime().halt(0);
+    }
+
+    static int run(Method main, String[] args, byte[] input, ByteArrayOutputStream output, ByteArrayOutputStream errors) {
+        InputStream originalIn = System.in;
+        PrintStream originalOut = System.out;
+        PrintStream originalErr = System.err;
+
+        PrintStream stdout = new PrintStream(output, true);
+        PrintStream stderr = new PrintStream(errors, true);
+        System.setIn(new ByteArrayInputStream(input));
+        System.setOut(stdout);
+        System.setErr(stderr);
+
+        try {
+            main.invoke(null, (Object) args);
+            return 0;
+        } catch (InvocationTargetException e) {
+            Throwable cause = e.getCause();
+            if (cause instanceof ExitException) {
+                return ((ExitException) cause).status;
+            }
+            cause.printStackTrace(stderr);
+            return 1;
+        } catch (IllegalAccessException e) {
+            e.printStackTrace(stderr);
+            return 1;
+        } finally {
+            stdout.flush();
+            stderr.flush();
+            System.setIn(originalIn);
+            System.setOut(originalOut);
+            System.setErr(originalErr);
+        }
+    }
+
+    /**
+     * Reads the length of the payload as ASCII digits, a newline, then the payload. Returns
+     * null if the stream ends before a full frame has been read.
+     */
+    static byte[] readFrame(InputStream in) throws IOException {
+        int length = 0;
+        int c;
+        while ((c = in.read()) != '\n') {
+            if (c == -1) {
+                return null;
+            }
+            if (c < '0' || c > '9') {
+                throw new IOException("Invalid frame header");
+            }
+            length = length * 10 + (c - '0');
+        }
+
+        byte[] payload = new byte[length];
+        int offset = 0;
+        while (offset < length) {
+            int read = in.read(payload, offset, length - offset);
+            if (read == -1) {
+                return null;
+            }
+            offset += read;
+        }
+        return payload;
+    }
+
+    static void writeFrame(OutputStream out, byte[] payload) throws IOException {
+        out.write((payload.length + "\n").getBytes("US-ASCII"));
+        out.write(payload);
+    }
+
+    /**
+     * Parses the JSON list of strings which the Python side sends as the arguments.
+     */
+    static String[] parseArguments(String json) throws IOException {
+        List<String> result = new ArrayList<String>();
+
+        int i = skipWhitespace(json, 0);
+        expect(json, i, '[');
+        i = skipWhitespace(json, i + 1);
+
+        if (json.charAt(i) != ']') {
+            while (true) {
+                expect(json, i, '"');
+                StringBuilder value = new StringBuilder();
+                i++;
+                while (json.charAt(i) != '"') {
+                    char c = json.charAt(i++);
+                    if (c != '\\') {
+                        value.append(c);
+                        continue;
+                    }
+
+                    char escaped = json.charAt(i++);
+                    switch (escaped) {
+                        case 'b': value.append('\b'); break;
+                        case 'f': value.append('\f'); break;
+                        case 'n': value.append('\n'); break;
+                        case 'r': value.append('\r'); break;
+                        case 't': value.append('\t'); break;
+                        case 'u':
+                            value.append((char) Integer.parseInt(json.substring(i, i + 4), 16));
+                            i += 4;
+                            break;
+                        default: value.append(escaped); //Quotes, backslashes and slashes
+                    }
+                }
+                result.add(value.toString());
+
+                i = skipWhitespace(json, i + 1);
+                if (json.charAt(i) == ']') {
+                    break;
+                }
+                expect(json, i, ',');
+                i = skipWhitespace(json, i + 1);
+            }
+        }
+        return result.toArray(new String[result.size()]);
+    }
+
+    static int skipWhitespace(String json, int i) {
+        while (i < json.length() && Character.isWhitespace(json.charAt(i))) {
+            i++;
+        }
+        return i;
+    }
+
+    static void expect(String json, int i, char c) throws IOException {
+        if (i >= json.length() || json.charAt(i) != c) {
+            throw new IOException("Expected '" + c + "' at " + i + " in the arguments: " + json);
+        }
+    }
+}
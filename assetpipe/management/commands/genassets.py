@@ -3,6 +3,7 @@ from optparse import make_option
 from django.core.management.base import BaseCommand, CommandError
 from django.conf import settings
 from assetpipe.base import build_generated_media_file
+from assetpipe.scheduler import run_bundles, BundleFailed
 
 class Command(BaseCommand):
     """ Command for generating production assets."""
@@ -12,6 +13,9 @@ class Command(BaseCommand):
         make_option('--pipeline', action='store', dest='pipeline',
             help='Specified which pipeline to run'
         ),
+        make_option('--jobs', action='store', dest='jobs', type='int', default=1,
+            help='The number of bundles to generate at the same time'
+        ),
     ]
     option_list = BaseCommand.option_list + tuple(extra_options)
 
@@ -26,8 +30,11 @@ class Command(BaseCommand):
         if options["pipeline"] not in settings.ASSET_PIPELINES:
             raise CommandError("%s is not a valid pipline" % options["pipeline"])
 
-        for k, v in settings.ASSET_PIPELINES[options["pipeline"]].items():
-            v.run()
+        try:
+            urls = run_bundles(options["pipeline"], jobs=options.get("jobs") or 1)
+        except (BundleFailed, ValueError), e:
+            raise CommandError(str(e))
 
-        build_generated_media_file(options["pipeline"])
+        #Only write the manifest once everything has been generated
+        build_generated_media_file(options["pipeline"], urls)
 
@@ -0,0 +1,92 @@
+""" A process-wide cache of the manifest written by genassets, which the template tags
+    use when ASSET_DEV_MODE is off.
+
+    The manifest is read once, along with the HTML for each bundle the first time it is
+    rendered. If ASSET_MANIFEST_CHECK_INTERVAL is set, the manifest's modification time is
+    checked at most once every that many seconds, and it is reloaded if it has changed, so
+    a new deployment's manifest is picked up without restarting.
+"""
+import os
+import time
+import logging
+import threading
+
+from .base import get_generated_media_filename, read_generated_media_file
+
+
+class ManifestCache(object):
+    def __init__(self):
+        self._lock = threading.Lock()
+        self._filename = None
+        self._mtime = None
+        self._checked = 0
+        #(manifest, {(tag, bundle name): HTML}), replaced in one go when reloading
+        self._state = None
+
+    def _stat(self, filename):
+        try:
+            return os.path.getmtime(filename)
+        except OSError:
+            return None
+
+    def _load(self, filename):
+        mtime = self._stat(filename)
+        manifest = read_generated_media_file()
+
+        self._filename = filename
+        self._mtime = mtime
+        self._state = (manifest, {})
+
+    def _check(self):
+        """ Loads the manifest if it hasn't been loaded, or if it has changed since, and
+            returns the current state.
+        """
+        from django.conf import settings
+
+        filename = get_generated_media_filename()
+        interval = getattr(settings, "ASSET_MANIFEST_CHECK_INTERVAL", None)
+
+        if self._state is not None and filename == self._filename:
+            if interval is None or time.time() - self._checked < interval:
+                return self._state
+
+        with self._lock:
+            if self._state is None or filename != self._filename:
+                self._load(filename)
+            elif interval is not None and time.time() - self._checked >= interval:
+                if self._stat(filename) != self._mtime:
+                    try:
+                        self._load(filename)
+                    except ValueError:
+                        #Most likely it's being written, so keep the old one until next time
+                        logging.exception("Unable to reload the asset manifest")
+            self._checked = time.time()
+            return self._state
+
+    def get_urls(self, bundle_name):
+        manifest, rendered = self._check()
+        return manifest[bundle_name]
+
+    def get_rendered(self, tag, bundle_name, render):
+        """ Returns render(urls) for the bundle, which is only called the first time
+            for each tag and bundle.
+        """
+        manifest, rendered = self._check()
+        key = (tag, bundle_name)
+        try:
+            return rendered[key]
+        except KeyError:
+            pass
+
+        result = rendered[key] = render(manifest[bundle_name])
+        return result
+
+    def clear(self):
+        with self._lock:
+            self._state = None
+
+
+_manifest_cache = ManifestCache()
+
+def get_manifest_cache():
+    return _manifest_cache
@@ -1,11 +1,48 @@
+import json
+import logging
+
 from django.conf import settings
 from django.core.exceptions import MiddlewareNotUsed
+from django.http import HttpResponse
 
 from assetpipe import gae_sandbox
+from assetpipe.builds import run_pipeline, background_builds_enabled, build_status, get_build_state
+from assetpipe.serving import unhashed_name
 
 IN_TESTING = getattr(settings, 'IN_TESTING', False)
 
 
+ERROR_CSS = u"""body:before {
+    content: "%s";
+    display: block;
+    white-space: pre-wrap;
+    font: 12px monospace;
+    color: #c00;
+    background: #fff;
+    border: 2px solid #c00;
+    padding: 1em;
+}
+"""
+
+
+def error_response(path, error):
+    """ Returns a stylesheet or script which shows error on the page, so that a failed build
+        is obvious without breaking the rest of it. Returns None for other types of file.
+    """
+    try:
+        detail = unicode(error)
+    except UnicodeDecodeError:
+        detail = str(error).decode("utf-8", "replace")
+
+    message = u"Asset build failed: %s" % detail
+    if path.endswith(".css"):
+        escaped = message.replace("\\", "\\\\").replace('"', '\\"').replace("\n", "\\A ")
+        return HttpResponse(ERROR_CSS % escaped, content_type="text/css")
+    if path.endswith(".js"):
+        return HttpResponse("throw new Error(%s);\n" % json.dumps(message), content_type="text/javascript")
+    return None
+
+
 class AssetMiddleware(object):
     def __init__(self):
         if not settings.ASSET_DEV_MODE:
@@ -25,21 +62,89 @@ class AssetMiddleware(object):
                 if setting is None:
                     raise ImproperlyConfigured("Missing assetpipe setting '%s'" % setting_name)
 
-    @gae_sandbox.allow_modules
-    def process_request(self, request):
+            self._build_index()
+
+    def _build_index(self):
+        """ Finds the URLs which the bundles of the active pipeline are served from, and
+            which bundle produces each of their outputs, so that each request only runs
+            the bundle which can serve it.
+        """
         active = getattr(settings, 'ASSET_PIPELINE_ACTIVE')
         pipelines = settings.ASSET_PIPELINES.get(active, {})
+        self.pipelines = [ pipelines[name] for name in sorted(pipelines.keys()) ]
 
+        #Longest first, so that the most specific bundles are tried first
+        url_roots = set(pipeline.head.url_root for pipeline in self.pipelines)
+        self.url_roots = sorted(url_roots, key=len, reverse=True)
+
+        self._index_outputs()
+
+    def _index_outputs(self):
+        """ Maps the unhashed URL of each bundle's outputs to the bundle. Only prepares the
+            bundles (which works out their output names), nothing is built.
+        """
+        outputs = {}
+        for pipeline in self.pipelines:
+            try:
+                #Preparing changes the pipeline, so don't do it while it's being built
+                with get_build_state(pipeline).build_lock:
+                    pipeline.head.prepare()
+                    urls = pipeline.output_urls()
+            except Exception:
+                logging.exception("Failed to find the outputs of a bundle served from %s", pipeline.head.url_root)
+                continue
+
+            for url in urls:
+                outputs.setdefault(unhashed_name(url), pipeline)
+        self.outputs = outputs
+
+    def _find(self, path):
+        """ Returns the bundle which produces path, or None. """
+        pipeline = self.outputs.get(unhashed_name(path))
+        if pipeline is None:
+            #The bundles' outputs may have changed (e.g. a file has been added), so look again
+            self._index_outputs()
+            pipeline = self.outputs.get(unhashed_name(path))
+        return pipeline
+
+    def _serve_unbuilt(self, path, request):
+        """ Lets the first bundle served from the URL serve a file which none of them
+            produce (e.g. an image), as before.
+        """
+        for url_root in self.url_roots:
+            if path.startswith(url_root):
+                for pipeline in self.pipelines:
+                    if pipeline.head.url_root == url_root:
+                        return pipeline.serve(path[len(url_root):], request)
+
+    @gae_sandbox.allow_modules
+    def process_request(self, request):
         if IN_TESTING:
             return
 
-        for pipeline in pipelines.values():
-            pipeline.run()
-            url_root = pipeline.head.url_root
+        if not any(request.path.startswith(url_root) for url_root in self.url_roots):
+            #Not an asset, so there's nothing to do
+            return
 
-            if not request.path.startswith(url_root):
-                #If the URL being requested is not a sub-path of the serving URL of this bundle
-                continue
+        pipeline = self._find(request.path)
+        if pipeline is None:
+            return self._serve_unbuilt(request.path, request)
+
+        try:
+            urls = run_pipeline(pipeline)
+        except Exception, e:
+            response = error_response(request.path, e)
+            if response is None:
+                raise
+            return response
+
+        for url in urls:
+            self.outputs[unhashed_name(url)] = pipeline
+
+        url_root = pipeline.head.url_root
+        return pipeline.serve(request.path[len(url_root):], request)
 
-            filename = request.path[len(url_root):]
-            return pipeline.serve(filename)
+    def process_response(self, request, response):
+        if background_builds_enabled():
+            response["X-Asset-Build"] = build_status()
+        return response
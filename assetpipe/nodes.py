@@ -2,10 +2,19 @@ from collections import OrderedDict
 import os
 import StringIO
 import glob
+import inspect
+import tempfile
 import logging
 
 from hashlib import md5
 
+from django.utils.encoding import smart_str
+
+try:
+    import json
+except ImportError:
+    from django.utils import simplejson as json
+
 from .processors import (
     Bundle,
     ClosureBuilder,
@@ -13,13 +22,18 @@ from .processors import (
     YUI,
     ClosureCompiler,
     Prepend,
-    Append
+    Append,
+    CSSMin,
+    JSMin
 )
 
-from .base import NullOutputter, NullProcessor #, NullCompiler, NullMinifier,
+from .base import NullOutputter, NullProcessor, write_atomically #, NullCompiler, NullMinifier,
+from .buffers import FileBuffer, IterBuffer, collect, iter_files
+from .buildcache import get_build_cache, incremental_builds_enabled, MemoryBuildCache
 from .outputters.blobstore import Blobstore
 from .outputters.filesystem import Filesystem
 from .outputters.gaefilesystem import GaeFilesystem
+from .outputters.s3 import S3
 
 PROCESSORS = {}
 OUTPUTTERS = {}
@@ -40,11 +54,14 @@ register_processor("scss", SCSS)
 register_processor("yui", YUI)
 register_processor("prepend", Prepend)
 register_processor("append", Append)
+register_processor("cssmin", CSSMin)
+register_processor("jsmin", JSMin)
 
 register_outputter("null", NullOutputter)
 register_outputter("blobstore", Blobstore)
 register_outputter("filesystem", Filesystem)
 register_outputter("gaefilesystem", GaeFilesystem)
+register_outputter("s3", S3)
 
 
 class Node(object):
@@ -130,6 +147,16 @@ class Node(object):
         """
         raise NotImplementedError()
 
+    def stream(self):
+        """ Yields this node's outputs as (filename, chunks) pairs. """
+        return iter_files(self.outputs)
+
+    def consumes_stream(self):
+        """ Return True if do_run pulls the parent's outputs through parent.stream(), so
+            that the parent can leave producing them until then.
+        """
+        return False
+
     #Generic methods which allow chaining of the nodes
     def Output(self, static_root, static_url, outputter, directory=None, *args, **kwargs):
         return OutputNode(static_root, static_url, self, outputter, directory, *args, **kwargs)
@@ -138,11 +165,37 @@ class Node(object):
         return ProcessNode(self, processor, *args, **kwargs)
 
 
+def _accepts_argument(func, name):
+    """ Returns True if func can be called with the keyword argument name. """
+    try:
+        args, varargs, keywords, defaults = inspect.getargspec(func)
+    except TypeError:
+        #Not a Python function, so assume that it does
+        return True
+    return name in args or keywords is not None
+
+
+#Files smaller than this are kept in memory while their content hash is worked out
+SPOOL_SIZE = 1024 * 1024
+
+#The directory (under the static root) where the content hashes of each bundle's outputs are kept. It's
+#served along with everything else, so the files only contain hashes and never the paths of the inputs
+CONTENT_NAMES_DIRECTORY = ".assetpipe-names"
+
+
 class OutputNode(Node):
     def __init__(self, static_root, static_url, parent, outputter_name, directory=None, *args, **kwargs):
+        """ If content_hash is True, each output is named by the hash of its contents rather
+            than the hash of the pipeline's inputs, so files which haven't changed keep
+            their URLs when others change (or when a fresh checkout changes the mtimes).
+        """
         super(OutputNode, self).__init__(parent)
 
         self.static_root = static_root
+        self.content_hash = kwargs.pop("content_hash", False)
+
+        #(pipeline hash, {hash of filename: hash of contents}) of the last run, with content_hash
+        self._content_names = None
 
         directory = os.path.join(static_root, directory or "")
 
@@ -163,17 +216,81 @@ class OutputNode(Node):
             )
         return result
 
-    def _add_hash_to_filename(self, filename):
-        def is_image(_filename):
-            return _filename.endswith(".png") or _filename.endswith(".gif")
+    def _is_image(self, filename):
+        return filename.endswith(".png") or filename.endswith(".gif")
 
-        if is_image(filename):
+    def _add_hash_to_filename(self, filename, hsh=None):
+        if self._is_image(filename):
             return filename
 
-        hsh = self.head.hash
+        if hsh is None:
+            if self.content_hash:
+                hsh = (self._get_content_names() or {}).get(self._content_name_key(filename))
+                if hsh is None:
+                    return filename
+            else:
+                hsh = self.head.hash
+
         part, ext = os.path.splitext(filename)
         return ".".join([part, hsh, ext.lstrip(".")])
 
+    def _get_content_names_filename(self):
+        head = self.head
+        key = md5("\0".join([head.url_root, self.outputter.directory or ""] + list(head.input_files))).hexdigest()
+        return os.path.join(self.static_root, CONTENT_NAMES_DIRECTORY, key + ".json")
+
+    def _content_name_key(self, filename):
+        return md5(smart_str(filename)).hexdigest()
+
+    def _get_content_names(self):
+        """ Returns the content hashes of the outputs for the current inputs, or None
+            if the pipeline hasn't been run with them. The names are also kept on disk, so
+            other processes (and restarts) can use them without running the pipeline.
+        """
+        hsh = self.head.hash
+        if self._content_names is None or self._content_names[0] != hsh:
+            try:
+                with open(self._get_content_names_filename()) as f:
+                    self._content_names = tuple(json.loads(f.read()))
+            except (IOError, ValueError):
+                return None
+
+        if self._content_names[0] != hsh:
+            return None
+        return self._content_names[1]
+
+    def _set_content_names(self, names):
+        self._content_names = (self.head.hash, names)
+
+        filename = self._get_content_names_filename()
+        if not os.path.exists(os.path.dirname(filename)):
+            try:
+                os.makedirs(os.path.dirname(filename))
+            except OSError:
+                if not os.path.isdir(os.path.dirname(filename)):
+                    raise
+        write_atomically(filename, [json.dumps(self._content_names)])
+
+    def _hash_contents(self, items, names, spooled):
+        """ Reads each of the (filename, chunks) pairs into a temporary file, so the output can
+            be named by its hash before it's written, and records the names.
+        """
+        for filename, chunks in items:
+            if self._is_image(filename):
+                yield filename, IterBuffer(chunks)
+                continue
+
+            f = tempfile.SpooledTemporaryFile(SPOOL_SIZE)
+            spooled.append(f)
+            hasher = md5()
+            for chunk in chunks:
+                hasher.update(chunk)
+                f.write(chunk)
+            f.seek(0)
+
+            names[self._content_name_key(filename)] = hasher.hexdigest()
+            yield self._add_hash_to_filename(filename, hasher.hexdigest()), f
+
     def do_prepare(self):
         new_inputs = OrderedDict()
         for filename, contents in self.inputs.items():
@@ -182,6 +299,10 @@ class OutputNode(Node):
         self._inputs = new_inputs
 
     def is_dirty(self):
+        if self.content_hash and self._get_content_names() is None:
+            #The outputs' names aren't known until it has been run with these inputs
+            return True
+
         for filename, contents in self.inputs.items():
             filename = self._add_hash_to_filename(filename)
             filename = self.outputter.get_output_filename(filename)
@@ -190,14 +311,41 @@ class OutputNode(Node):
                 return True
         return False
 
+    def consumes_stream(self):
+        return True
+
     def do_run(self):
         #OutputNode is the only type of node which does not alter self.outputs
-        for filename, contents in self.inputs.items():
-            filename = self._add_hash_to_filename(filename)
-            filename = self.outputter.get_output_filename(filename)
-            self.outputter.output(filename, contents)
+        if self.content_hash:
+            names = {}
+            spooled = []
+            items = self._hash_contents(self.parent.stream(), names, spooled)
+        else:
+            items = (
+                (self._add_hash_to_filename(filename), IterBuffer(chunks))
+                for filename, chunks in self.parent.stream()
+            )
+        items = ( (self.outputter.get_output_filename(filename), f) for filename, f in items )
 
-    def serve(self, filename):
+        try:
+            output_files = getattr(self.outputter, "output_files", None)
+            if output_files is not None:
+                output_files(items)
+            else:
+                for filename, file_out in items:
+                    self.outputter.output(filename, file_out)
+        finally:
+            if self.content_hash:
+                for f in spooled:
+                    f.close()
+
+        if self.content_hash:
+            self._set_content_names(names)
+
+    def serve(self, filename, request=None):
+        #Outputters written before serve() was passed the request only take the filename
+        if _accepts_argument(self.outputter.serve, "request"):
+            return self.outputter.serve(filename, request=request)
         return self.outputter.serve(filename)
 
 
@@ -209,6 +357,12 @@ class ProcessNode(Node):
         """
         super(ProcessNode, self).__init__(parent)
         self.processor = PROCESSORS[processor_name](self.head, *args, **kwargs)
+        self.processor_args = args
+        self.processor_kwargs = kwargs
+        self._memory_cache = None
+
+        #True while the outputs are left for the next stage to pull through stream()
+        self._deferred = False
 
     def do_prepare(self):
         self.outputs = self.processor.prepare(self.inputs)
@@ -216,33 +370,205 @@ class ProcessNode(Node):
     def is_dirty(self):
         return False
 
+    def get_build_cache(self):
+        """ Returns the cache to use for this run, if any. For incremental builds the
+            outputs of the last run are kept in memory in front of the on-disk cache.
+        """
+        cache = get_build_cache()
+        if not incremental_builds_enabled():
+            return cache
+
+        if self._memory_cache is None or self._memory_cache.backend is not cache:
+            self._memory_cache = MemoryBuildCache(cache)
+        return self._memory_cache
+
+    def _streams(self):
+        """ Returns True if files are passed through this node's processor with stream()
+            rather than all at once.
+        """
+        if not self.processor.streaming:
+            return False
+        return not self.processor.cacheable or self.get_build_cache() is None
+
+    def consumes_stream(self):
+        return self._streams()
+
+    def stream(self):
+        if not self._deferred:
+            return super(ProcessNode, self).stream()
+        return self._record_outputs(self.processor.stream(self.parent.stream()))
+
+    def _record_outputs(self, items):
+        """ Passes items through, keeping track of the filenames for output_urls(). """
+        outputs = OrderedDict()
+        for filename, chunks in items:
+            outputs[filename] = None
+            yield filename, chunks
+        self.outputs = outputs
+
     def do_run(self):
-        self.outputs = self.processor.process(self.inputs)
+        self._deferred = False
+        if self._streams():
+            self._deferred = True
+            if not (self.child and self.child.consumes_stream()):
+                #The next stage needs all of the outputs at once
+                self.outputs = collect(self.stream())
+                self._deferred = False
+            return
+
+        cache = self.get_build_cache()
+        if cache is None or not self.processor.cacheable:
+            self.outputs = self.processor.process(self.inputs)
+            return
+
+        if self.processor.per_file:
+            self.outputs = self._run_cached_per_file(cache)
+        else:
+            self.outputs = self._run_cached(cache)
+
+        cache.maybe_prune()
+
+    def _read_inputs(self):
+        """ Returns the inputs as a list of (filename, content) pairs. """
+        result = []
+        for filename, contents in self.inputs.items():
+            result.append((filename, contents.read()))
+        return result
+
+    def get_config_parts(self):
+        """ Returns a list of strings describing this processor and its configuration,
+            anything which could change its output for the same inputs.
+        """
+        processor_class = self.processor.__class__
+        parts = [
+            processor_class.__module__,
+            processor_class.__name__,
+            repr(self.processor_args),
+            repr(sorted(self.processor_kwargs.items())),
+        ]
+        parts.extend(self.processor.get_cache_key_parts())
+        return parts
+
+    def _cache_key(self, cache, inputs):
+        """ Returns the build cache key for running this processor on the given
+            list of (filename, content) pairs.
+        """
+        parts = self.get_config_parts()
+
+        for filename, content in inputs:
+            parts.extend([filename, content])
+
+        filenames = [ filename for filename, content in inputs ]
+        for dep in self.processor.get_cache_dependencies(filenames):
+            parts.extend([dep, cache.file_digest(dep)])
+
+        return cache.make_key(*parts)
+
+    def _run_cached(self, cache):
+        """ Runs the processor over the whole stage, unless the build cache
+            already has the outputs for these exact inputs.
+        """
+        inputs = self._read_inputs()
+        key = self._cache_key(cache, inputs)
+
+        cached = cache.get(key)
+        if cached is None:
+            outputs = self.processor.process(_to_files(inputs))
+            cached = [ (filename, contents.read()) for filename, contents in outputs.items() ]
+            cache.set(key, cached)
+
+        return _to_files(cached)
+
+    def _run_cached_per_file(self, cache):
+        """ Looks up each input in the build cache individually, and only passes
+            the misses to the processor (in a single call).
+        """
+        results = OrderedDict()
+        misses = OrderedDict()
+        keys = {}
+
+        for filename, content in self._read_inputs():
+            key = self._cache_key(cache, [(filename, content)])
+            cached = cache.get(key)
+            if cached is None:
+                misses[filename] = content
+                keys[filename] = key
+            results[filename] = cached
+
+        if misses:
+            outputs = self.processor.process(_to_files(misses.items()))
+            assert len(outputs) == len(misses), \
+                "%s must return one output per input" % self.processor.__class__.__name__
+
+            for filename, (output_filename, contents) in zip(misses.keys(), outputs.items()):
+                cached = [(output_filename, contents.read())]
+                cache.set(keys[filename], cached)
+                results[filename] = cached
+
+        return _to_files(y for x in results.values() for y in x)
+
+
+def _to_files(items):
+    """ Converts an iterable of (filename, content) pairs into the OrderedDict
+        of filename: StringIO(content) which processors expect.
+    """
+    outputs = OrderedDict()
+    for filename, content in items:
+        output = StringIO.StringIO()
+        output.write(content)
+        output.seek(0)
+        outputs[filename] = output
+    return outputs
 
 
 class Gather(Node):
     """ The starting node of every pipeline.  Picks up the specified
         files from the filesystem and puts them into self.outputs.
     """
-    def __init__(self, inputs, dependencies=[], filenames=True):
+    def __init__(self, inputs, dependencies=[], filenames=True, requires=[]):
         super(Gather, self).__init__(None)
 
-        #Try to glob match the inputs
-        expanded_inputs = [] #will contain the full list of files, not just folder/*
         assert not isinstance(inputs, basestring), "inputs should be a list or iterable, not string"
-        for inp in inputs:
-            if filenames:
-                #Deal with wildcards which refer to directories
-                matches = glob.glob(inp)
-                if matches:
-                    expanded_inputs.extend(matches)
-            else:
-                expanded_inputs.append(inp)
-
-        self.input_files = expanded_inputs if filenames else inputs
+        self.input_patterns = list(inputs)
         self.input_files_are_filenames = filenames
+
+        #The inputs are expanded again each time the pipeline is prepared, because they
+        #may not exist yet (e.g. if they're generated by a bundle that this one requires)
+        self.input_files = self.expand_inputs() if filenames else inputs
+
+        #path: (mtime, size, content) of the files read by the last run, so that
+        #incremental builds only need to re-read the files which have changed
+        self._file_contents = {}
         self.dependencies = dependencies
 
+        #The files matched by the dependencies, expanded once each time the pipeline is
+        #prepared so that processors don't have to glob them again for every input file
+        self.dependency_files = []
+
+        #The names of other bundles in the same pipeline which genassets must
+        #generate before this one, e.g. because this bundle gathers their output
+        self.requires = requires
+
+    def expand_inputs(self):
+        """ Returns the list of input files, with wildcards expanded. """
+        expanded_inputs = [] #will contain the full list of files, not just folder/*
+        for inp in self.input_patterns:
+            #Deal with wildcards which refer to directories
+            matches = glob.glob(inp)
+            if matches:
+                expanded_inputs.extend(matches)
+        return expanded_inputs
+
+    def expand_dependencies(self):
+        """ Returns the list of files matched by the dependencies, with wildcards expanded. """
+        from .glob import glob_many
+
+        matches = glob_many(self.dependencies)
+        result = []
+        for dep in self.dependencies:
+            result.extend(sorted(matches[dep]))
+        return result
+
     def generate_hash(self, *args, **kwargs):
         parts = [ self.__class__.__name__ ] + [ str(x) for x in args ]
         for k in sorted(kwargs.keys()):
@@ -258,12 +584,15 @@ class Gather(Node):
         """
             Returns a hash representing this pipeline combined with its inputs
         """
-        from .glob import glob
+        from .glob import glob_many
 
         hasher = md5()
 
+        #Expand all of the patterns at once, so that patterns with the same root share a walk
+        matches = glob_many(list(inputs) + list(dependencies))
+
         join = lambda it: (y for x in it for y in x)
-        expanded_inputs = list(join([ glob(x) for x in inputs]))
+        expanded_inputs = list(join([ matches[x] for x in inputs]))
 
         for inp in sorted(expanded_inputs):
             if filenames:
@@ -274,16 +603,76 @@ class Gather(Node):
 
         for dep in dependencies:
             # Update hasher for every file in dependencies
-            for f in sorted(glob(dep)) if not os.path.isfile(dep) else [dep]:
+            for f in sorted(matches[dep]) if not os.path.isfile(dep) else [dep]:
                 u = str(os.path.getmtime(f))
                 hasher.update(u)
 
         return hasher.hexdigest()
 
+    def get_processor_dependencies(self):
+        """ Returns the files which the processors in the pipeline report that they read
+            when processing the input files, e.g. the partials imported by SCSS files.
+        """
+        if not self.input_files_are_filenames:
+            return []
+
+        result = []
+        node = self.child
+        while node:
+            if isinstance(node, ProcessNode):
+                result.extend(node.processor.get_dependencies(self.input_files))
+            node = node.child
+        return result
+
+    def get_processor_config(self):
+        """ Returns the configuration of each of the processors in the pipeline, so that
+            changing a processor or its settings changes the pipeline hash.
+        """
+        result = []
+        node = self.child
+        while node:
+            if isinstance(node, ProcessNode):
+                result.extend(node.get_config_parts())
+            node = node.child
+        return result
+
+    def get_watched_paths(self):
+        """ Returns a list of (directory, recursive) pairs which contain all of the files
+            that this pipeline reads, for use with the watcher.
+        """
+        from .glob import has_wildcards
+
+        result = set()
+
+        if self.input_files_are_filenames:
+            for f in self.input_files + self.get_processor_dependencies():
+                result.add((os.path.dirname(os.path.abspath(f)), False))
+
+        for dep in self.dependencies:
+            if os.path.isfile(dep):
+                result.add((os.path.dirname(os.path.abspath(dep)), False))
+            else:
+                #Watch everything under the directories before the first wildcard, recursively
+                #if any of the directories (rather than just the filename) has a wildcard
+                parts = dep.split(os.sep)
+                index = 0
+                while index < len(parts) - 1 and not has_wildcards(parts[index]):
+                    index += 1
+                root = os.sep.join(parts[:index])
+                result.add((os.path.abspath(root or "."), index < len(parts) - 1))
+
+        return sorted(result)
+
     def do_prepare(self):
-        # FIXME: This currently doesn't take into account the pipeline itself, the pipeline steps need to be included in the hash
-        pipeline_hash = self.generate_pipeline_hash(self.input_files, dependencies=self.dependencies, filenames=True)
-        self.hash = self.generate_hash(*(self.input_files + [] + [pipeline_hash]))
+        if self.input_files_are_filenames:
+            self.input_files = self.expand_inputs()
+
+        #The hash covers the processors as well as the inputs, as outputs named by it are
+        #served as immutable
+        self.dependency_files = self.expand_dependencies()
+        dependencies = self.dependency_files + self.get_processor_dependencies()
+        pipeline_hash = self.generate_pipeline_hash(self.input_files, dependencies=dependencies, filenames=True)
+        self.hash = self.generate_hash(*(self.input_files + self.get_processor_config() + [pipeline_hash]))
 
     def is_dirty(self):
         outputs = OrderedDict()
@@ -297,10 +686,13 @@ class Gather(Node):
 
         outputs = OrderedDict()
         for inp in self.input_files:
+            if isinstance(inp, basestring) and not incremental_builds_enabled():
+                #Nothing is read until a later stage needs it
+                outputs[inp] = FileBuffer(inp)
+                continue
+
             if isinstance(inp, basestring):
-                f = open(inp, "r")
-                content = f.read()
-                f.close()
+                content = self._read_file(inp)
             else:
                 content = inp
 
@@ -309,3 +701,14 @@ class Gather(Node):
             output.seek(0) #Rewind to the beginning
             outputs[inp] = output
         self.outputs = outputs
+
+    def _read_file(self, path):
+        stat = os.stat(path)
+        cached = self._file_contents.get(path)
+        if cached and cached[:2] == (stat.st_mtime, stat.st_size):
+            return cached[2]
+
+        with open(path, "r") as f:
+            content = f.read()
+        self._file_contents[path] = (stat.st_mtime, stat.st_size, content)
+        return content
@@ -1,24 +1,173 @@
 import os
+import time
 import logging
+import calendar
+import threading
 
-from django.http import HttpResponse, HttpResponseNotFound
+from multiprocessing.pool import ThreadPool
+
+from django.http import HttpResponseNotFound
 from django.conf import settings
 from django.core.exceptions import ImproperlyConfigured
 
-from ..base import Outputter
+from ..base import Outputter, get_keep_generations
+from ..buffers import iter_chunks
+from ..serving import file_response, unhashed_name
 try:
     #Import the Google App Engine Blobstore if we have it
     #but don't die (yet) if we don't.
     from google.appengine.api import files
-    from google.appengine.ext.blobstore import BlobInfo, BlobReader
+    from google.appengine.ext.blobstore import BlobInfo, BlobReader, delete as delete_blobs
     HAVE_BLOBSTORE = True
 except ImportError:
     HAVE_BLOBSTORE = False
 
 
+INDEX_CACHE_KEY = "assetpipe:blobstore:index"
+
+DEFAULT_CHUNK_SIZE = 512 * 1024
+DEFAULT_UPLOAD_WORKERS = 4
+
+#Seconds to wait between checks for a finalized blob's key, doubling up to the maximum
+BLOB_KEY_INITIAL_DELAY = 0.05
+BLOB_KEY_MAX_DELAY = 1.0
+BLOB_KEY_TIMEOUT = 30
+
+
+def _batched(chunks, size):
+    """ Re-splits chunks into pieces of size bytes (apart from the last one), so that every
+        write to the Blobstore is the same size however the contents were produced.
+    """
+    pending = ""
+    for chunk in chunks:
+        pending += chunk
+        offset = 0
+        while len(pending) - offset >= size:
+            yield pending[offset:offset + size]
+            offset += size
+        pending = pending[offset:]
+    if pending:
+        yield pending
+
+
+def wait_for_blob_key(handle):
+    """ Returns the key of the finalized blob, checking with an increasing delay rather
+        than as fast as possible, and giving up after BLOB_KEY_TIMEOUT seconds.
+    """
+    delay = BLOB_KEY_INITIAL_DELAY
+    deadline = time.time() + BLOB_KEY_TIMEOUT
+    while True:
+        blob_key = files.blobstore.get_blob_key(handle)
+        if blob_key:
+            return blob_key
+
+        if time.time() + delay > deadline:
+            raise IOError("Timed out waiting for the key of blob %s" % handle)
+        time.sleep(delay)
+        delay = min(delay * 2, BLOB_KEY_MAX_DELAY)
+
+
+def _blob_details(info):
+    return {
+        "key": str(info.key()),
+        "content_type": info.content_type,
+        "size": info.size,
+        "md5_hash": info.md5_hash,
+        "creation": calendar.timegm(info.creation.utctimetuple()),
+    }
+
+
+class BlobIndex(object):
+    """ An index of filename: blob details for all of the blobs, so that the outputter
+        doesn't have to query BlobInfo for every check and request. It's kept in memory
+        and in Django's cache, and rebuilt from a single query of all the BlobInfos
+        when it isn't in either. The filenames are also indexed by their unhashed name,
+        to find the other versions of a file.
+    """
+
+    def __init__(self):
+        self._lock = threading.RLock()
+        self._blobs = None
+        self._versions = None
+
+    def _set(self, blobs):
+        versions = {}
+        for filename in blobs:
+            versions.setdefault(unhashed_name(filename), set()).add(filename)
+
+        self._blobs = blobs
+        self._versions = versions
+
+    def _save(self, blobs):
+        from django.core.cache import cache
+
+        self._set(blobs)
+        cache.set(INDEX_CACHE_KEY, blobs)
+
+    def rebuild(self):
+        with self._lock:
+            self._save(dict((info.filename, _blob_details(info)) for info in BlobInfo.all()))
+
+    def refresh(self):
+        """ Reloads the index from the cache, in case another instance has changed it. """
+        from django.core.cache import cache
+
+        with self._lock:
+            blobs = cache.get(INDEX_CACHE_KEY)
+            if blobs is None:
+                self.rebuild()
+            else:
+                self._set(blobs)
+
+    def _get_blobs(self):
+        if self._blobs is None:
+            self.refresh()
+        return self._blobs
+
+    def get(self, filename):
+        return self._get_blobs().get(filename)
+
+    def filenames(self):
+        return self._get_blobs().keys()
+
+    def versions(self, names):
+        """ Returns unhashed name: {filename: blob details} for each of the given unhashed
+            names, all read at the same time so that other threads can't change them part way.
+        """
+        with self._lock:
+            blobs = self._get_blobs()
+            return dict(
+                (name, dict((filename, blobs[filename]) for filename in self._versions.get(name, ())))
+                for name in names
+            )
+
+    def add(self, filename, info):
+        with self._lock:
+            blobs = dict(self._get_blobs())
+            blobs[filename] = _blob_details(info)
+            self._save(blobs)
+
+    def remove(self, filenames):
+        with self._lock:
+            blobs = dict(self._get_blobs())
+            for filename in filenames:
+                blobs.pop(filename, None)
+            self._save(blobs)
+
+    def clear(self):
+        self._blobs = None
+
+
+_index = BlobIndex()
+
+def get_blob_index():
+    return _index
+
+
 class Blobstore(Outputter):
 
-    def __init__(self, directory=None, strip_path=None, *args, **kwargs):
+    def __init__(self, directory=None, strip_path=None, keep_generations=None, *args, **kwargs):
+        """ keep_generations is how many versions of each file to keep, see get_keep_generations(). """
         if not HAVE_BLOBSTORE:
             raise ImproperlyConfigured(
                 "Google Appengine components required for the 'blobstore' "
@@ -26,12 +175,51 @@ class Blobstore(Outputter):
             )
         super(Blobstore, self).__init__(directory, strip_path)
 
-    def output(self, filename, file_out):
+        self.chunk_size = getattr(settings, "ASSET_BLOBSTORE_CHUNK_SIZE", DEFAULT_CHUNK_SIZE)
+        self.upload_workers = getattr(settings, "ASSET_BLOBSTORE_UPLOAD_WORKERS", DEFAULT_UPLOAD_WORKERS)
+        self._keep_generations = keep_generations
+
+    @property
+    def keep_generations(self):
+        #Outputters are created while the settings are being loaded, so read them when needed
+        return get_keep_generations(self._keep_generations)
+
+    def output_files(self, items):
+        """ Uploads the files on up to ASSET_BLOBSTORE_UPLOAD_WORKERS threads at once, then
+            deletes the versions of them which are no longer needed.
+        """
+        items = list(items)
+
+        def run(item):
+            try:
+                self.output(*item)
+            except Exception, e:
+                logging.exception("Failed to upload %s", item[0])
+                return e
+
+        workers = min(self.upload_workers, len(items))
+        if workers > 1:
+            pool = ThreadPool(workers)
+            try:
+                results = pool.map(run, items)
+            finally:
+                pool.close()
+                pool.join()
+        else:
+            results = map(run, items)
+
+        errors = [ "%s: %s" % (item[0], error) for item, error in zip(items, results) if error is not None ]
+        if errors:
+            raise ValueError("Failed to upload %d file(s):\n%s" % (len(errors), "\n".join(errors)))
+
+        self.remove_stale([ filename for filename, file_out in items ])
+
+    def get_blob_name(self, filename):
         if filename.startswith(settings.STATIC_ROOT):
             filename = filename[len(settings.STATIC_ROOT) + 1:]
+        return filename
 
-        content = file_out.read()
-
+    def get_mimetype(self, filename):
         base, ext = os.path.splitext(filename)
 
         if ext == ".css":
@@ -44,33 +232,55 @@ class Blobstore(Outputter):
             mimetype = "image/gif"
         else:
             mimetype = "application/octet-stream"
+        return mimetype
 
-        already_exists = False
+    def remove_stale(self, filenames):
+        """ Deletes the other versions (i.e. with different hashes) of the given files, apart
+            from the most recently created ones which are still kept. The new versions have to
+            be written first, as pages may link to the previous ones until then.
+        """
+        index = get_blob_index()
+        keep_generations = self.keep_generations
+
+        #The number of current versions of each file
+        current = {}
+        filenames = set(self.get_blob_name(filename) for filename in filenames)
+        for filename in filenames:
+            name = unhashed_name(filename)
+            current[name] = current.get(name, 0) + 1
+
+        stale = []
+        for name, versions in index.versions(current.keys()).items():
+            older = sorted(
+                ((blob["creation"], filename, blob["key"]) for filename, blob in versions.items() if filename not in filenames),
+                reverse=True
+            )
+            stale.extend(older[max(0, keep_generations - current[name]):])
 
-        for info in BlobInfo.all().filter('content_type = ', mimetype):
-            if info.filename == filename:
-                already_exists = True
-                continue
+        if stale:
+            stale.sort(key=lambda x: x[1])
+            logging.debug("Deleting: %s", ", ".join(filename for creation, filename, key in stale))
+            delete_blobs([ key for creation, filename, key in stale ])
+            index.remove([ filename for creation, filename, key in stale ])
 
-            #Clear out old blobs
-            if info.filename.split(".")[0] == filename.split(".")[0]:
-                logging.debug("Deleting: %s", info.filename)
-                info.delete()
+    def output(self, filename, file_out):
+        filename = self.get_blob_name(filename)
+        mimetype = self.get_mimetype(filename)
+        index = get_blob_index()
 
-        if not already_exists:
+        if index.get(filename) is None:
             logging.info("Creating: %s", filename)
             result = files.blobstore.create(mime_type=mimetype, _blobinfo_uploaded_filename=filename)
             with files.open(result, "a") as f:
-                f.write(content)
+                for chunk in _batched(iter_chunks(file_out, self.chunk_size), self.chunk_size):
+                    f.write(chunk)
             files.finalize(result)
 
-            blob_key = files.blobstore.get_blob_key(result)
-            while not blob_key:
-                blob_key = files.blobstore.get_blob_key(result)
+            blob_key = wait_for_blob_key(result)
+            index.add(filename, BlobInfo.get(blob_key))
 
     def file_up_to_date(self, filename):
-        result = bool(BlobInfo.all().filter('filename =', filename).count())
-        return result
+        return get_blob_index().get(filename) is not None
 
     def get_output_filename(self, filename):
         """ Override this to return just the filename and not the full path,
@@ -78,12 +288,17 @@ class Blobstore(Outputter):
         """
         return filename
 
-    def serve(self, filename):
-        #TODO: Surely if this file is served from a hash-based URL then we
-        #can return HTTP caching headers, right?
-        info = BlobInfo.all().filter('filename = ', filename).get()
-        if not info:
+    def serve(self, filename, request=None):
+        index = get_blob_index()
+        blob = index.get(filename)
+        if blob is None:
+            #It may have been created by another instance since we loaded the index
+            index.refresh()
+            blob = index.get(filename)
+        if blob is None:
             return HttpResponseNotFound()
-            #
-        content = BlobReader(info.key()).read()
-        return HttpResponse(content, content_type=info.content_type)
+
+        return file_response(
+            request, filename, lambda: BlobReader(blob["key"]),
+            blob["size"], blob["creation"], '"%s"' % blob["md5_hash"], blob["content_type"]
+        )
@@ -1,37 +1,190 @@
 import os
 import sys
-import glob
+import zlib
+import errno
 import logging
+import threading
+
+from contextlib import contextmanager
 
 from django.conf import settings
-from django.http import HttpResponse
+from django.http import HttpResponseNotFound
+
+from ..base import Outputter, get_keep_generations, write_atomically
+from ..buffers import FileBuffer, IterBuffer, iter_chunks
+from ..serving import file_response, accepted_encodings, unhashed_name
+
+try:
+    import json
+except ImportError:
+    from django.utils import simplejson as json
+
+try:
+    import brotli
+    HAVE_BROTLI = True
+except ImportError:
+    HAVE_BROTLI = False
+
+try:
+    import fcntl
+    HAVE_FCNTL = True
+except ImportError:
+    HAVE_FCNTL = False
+
+#Each output directory has a manifest of the versions of the files written to it
+MANIFEST_FILENAME = ".assetpipe-outputs.json"
+
+#manifest path: threading.Lock
+_manifest_locks = {}
+_manifest_locks_lock = threading.Lock()
+
+#Only text is worth compressing, images are already compressed
+COMPRESSIBLE_EXTENSIONS = (".css", ".js", ".svg", ".json")
+
+
+def gzip_chunks(chunks):
+    #16 + MAX_WBITS gives gzip headers rather than zlib ones
+    compressor = zlib.compressobj(9, zlib.DEFLATED, 16 + zlib.MAX_WBITS)
+    for chunk in chunks:
+        yield compressor.compress(chunk)
+    yield compressor.flush()
+
+
+def brotli_chunks(chunks):
+    compressor = brotli.Compressor(quality=11)
+    for chunk in chunks:
+        yield compressor.process(chunk)
+    yield compressor.finish()
 
-from ..base import Outputter
+
+#(Content-Encoding, file suffix, compressor), most preferred first
+ENCODINGS = [ ("gzip", ".gz", gzip_chunks) ]
+if HAVE_BROTLI:
+    ENCODINGS.insert(0, ("br", ".br", brotli_chunks))
+
+ENCODED_SUFFIXES = (".gz", ".br")
+
+
+@contextmanager
+def _manifest_lock(path, use_file=True):
+    """ Holds a lock on the manifest while it is updated. If use_file is True and file
+        locking is available, the lock is also taken by other processes (e.g. genassets --jobs).
+    """
+    with _manifest_locks_lock:
+        lock = _manifest_locks.setdefault(path, threading.Lock())
+
+    with lock:
+        if not use_file or not HAVE_FCNTL:
+            yield
+            return
+
+        with open(path + ".lock", "a") as f:
+            fcntl.flock(f.fileno(), fcntl.LOCK_EX)
+            try:
+                yield
+            finally:
+                fcntl.flock(f.fileno(), fcntl.LOCK_UN)
 
 
 class Filesystem(Outputter):
-    def output(self, filename, file_out):
-        content = file_out.read()
+    #Whether the manifest is locked against other processes as well as other threads
+    lock_manifest_file = True
 
-        base, ext = os.path.splitext(filename)
+    def __init__(self, directory=None, strip_path=None, precompress=False, keep_generations=None):
+        """ If precompress is True, a .gz (and .br if the brotli package is installed) copy
+            of each text file is written alongside it, and served to clients which accept it.
+
+            keep_generations is how many versions of each file to keep, see get_keep_generations().
+        """
+        super(Filesystem, self).__init__(directory, strip_path)
+        self.precompress = precompress
 
-        already_exists = False
-        #Remove any existing stale entries
-        for f in glob.glob(os.path.join(self.directory, base.split(".")[0] + "*" + ext)):
-            if f[len(self.directory):].lstrip("/") == filename:
-                already_exists = True
-                continue
+        self._keep_generations = keep_generations
 
-            os.remove(f)
+    @property
+    def keep_generations(self):
+        #Outputters are created while the settings are being loaded, so read them when needed
+        return get_keep_generations(self._keep_generations)
 
+    def get_encodings(self, filename):
+        """ Returns the ENCODINGS which filename is precompressed with. """
+        if not self.precompress or os.path.splitext(filename)[1] not in COMPRESSIBLE_EXTENSIONS:
+            return []
+        return ENCODINGS
+
+    def output(self, filename, file_out):
         if not os.path.exists(os.path.dirname(filename)):
             os.makedirs(os.path.dirname(filename))
 
-        if not already_exists:
-            logging.info("Creating: %s", filename)
-
-            with open(filename, "w") as f:
-                f.write(content)
+        logging.info("Creating: %s", filename)
+        self.write(filename, file_out)
+
+        for encoding, suffix, compress in self.get_encodings(filename):
+            self.write(filename + suffix, IterBuffer(compress(iter_chunks(FileBuffer(filename)))))
+
+    def output_files(self, items):
+        """ Outputs the files, then records them in the manifest and removes the
+            versions which they replace.
+        """
+        filenames = []
+        for filename, file_out in items:
+            self.output(filename, file_out)
+            filenames.append(filename)
+
+        if filenames:
+            self.remove_stale(filenames)
+
+    def write(self, filename, file_out):
+        """ Streams file_out to a temporary file and moves it into place, so that the
+            file is never served half written.
+        """
+        write_atomically(filename, iter_chunks(file_out))
+
+    def get_manifest_filename(self):
+        return os.path.join(self.directory, MANIFEST_FILENAME)
+
+    def read_manifest(self):
+        """ Returns the manifest, a dictionary of the name of each file (without its hash, and
+            relative to the directory) to the list of its versions, newest first.
+        """
+        try:
+            with open(self.get_manifest_filename()) as f:
+                return json.loads(f.read())
+        except IOError, e:
+            if e.errno != errno.ENOENT:
+                raise
+        except ValueError:
+            logging.warning("Ignoring the corrupt output manifest %s", self.get_manifest_filename())
+        return {}
+
+    def remove_stale(self, filenames):
+        """ Adds filenames to the manifest as the newest versions of their files, and
+            removes any versions (and their compressed copies) which are no longer kept.
+        """
+        manifest_filename = self.get_manifest_filename()
+        keep_generations = self.keep_generations
+        with _manifest_lock(manifest_filename, self.lock_manifest_file):
+            old = self.read_manifest()
+            new = dict(old)
+            for filename in filenames:
+                filename = os.path.relpath(filename, self.directory)
+                name = unhashed_name(filename)
+                versions = [filename] + [ x for x in new.get(name, []) if x != filename ]
+                new[name] = versions[:keep_generations]
+
+            stale = set(x for versions in old.values() for x in versions)
+            stale.difference_update(x for versions in new.values() for x in versions)
+
+            self.write(manifest_filename, json.dumps(new, indent=1, sort_keys=True))
+
+            for filename in sorted(stale):
+                logging.debug("Deleting: %s", filename)
+                for suffix in ("",) + ENCODED_SUFFIXES:
+                    try:
+                        os.remove(os.path.join(self.directory, filename + suffix))
+                    except OSError, e:
+                        if e.errno != errno.ENOENT:
+                            raise
 
     def file_up_to_date(self, filename):
         #FIXME: Check timestamp instead of returning false for images
@@ -42,9 +195,12 @@ class Filesystem(Outputter):
         if "genassets" in sys.argv:
             return False
 
-        return os.path.exists(filename)
+        return all(
+            os.path.exists(filename + suffix)
+            for suffix in [""] + [ x[1] for x in self.get_encodings(filename) ]
+        )
 
-    def serve(self, filename):
+    def serve(self, filename, request=None):
         base, ext = os.path.splitext(filename)
 
         if ext == ".css":
@@ -55,6 +211,31 @@ class Filesystem(Outputter):
             mimetype = "application/octet-stream"
 
         file_path = os.path.join(settings.STATIC_ROOT, filename)
-        content = open(file_path, "r").read()
 
-        return HttpResponse(content, content_type=mimetype)
+        #Use the best precompressed copy that the client accepts
+        encodings = self.get_encodings(filename)
+        content_encoding = None
+        if encodings and request is not None:
+            accepted = accepted_encodings(request)
+            for encoding, suffix, compress in encodings:
+                if encoding in accepted and os.path.exists(file_path + suffix):
+                    file_path += suffix
+                    content_encoding = encoding
+                    break
+
+        try:
+            stat = os.stat(file_path)
+        except OSError:
+            return HttpResponseNotFound()
+
+        etag = '"%x-%x%s"' % (
+            int(stat.st_mtime * 1000000), stat.st_size, "-" + content_encoding if content_encoding else ""
+        )
+        response = file_response(
+            request, filename, lambda: open(file_path, "rb"),
+            stat.st_size, stat.st_mtime, etag, mimetype, content_encoding
+        )
+
+        if encodings:
+            response["Vary"] = "Accept-Encoding"
+        return response
@@ -0,0 +1,465 @@
+""" An outputter which uploads to an S3-compatible object store (e.g. Amazon S3, or a
+    CDN origin such as MinIO or Ceph), using path-style URLs and AWS Signature Version 4.
+
+    Objects are uploaded over a pool of keep-alive connections, up to
+    ASSET_S3_UPLOAD_WORKERS at a time. A listing of the bucket (under the outputter's
+    directory) is shared by the outputters in the process, so files whose content is
+    already there aren't uploaded again, and once a bundle's files are uploaded the
+    versions they replace are deleted in batches.
+"""
+import os
+import time
+import hmac
+import base64
+import socket
+import httplib
+import logging
+import urllib
+import urlparse
+import datetime
+import tempfile
+import threading
+import Queue
+
+from hashlib import md5, sha256
+from multiprocessing.pool import ThreadPool
+from xml.etree import ElementTree
+from xml.sax.saxutils import escape
+
+from django.conf import settings
+from django.core.exceptions import ImproperlyConfigured
+from django.http import HttpResponseRedirect
+
+from ..base import Outputter, get_keep_generations
+from ..buffers import CHUNK_SIZE, iter_chunks
+from ..serving import IMMUTABLE_CACHE_CONTROL, REVALIDATE_CACHE_CONTROL, is_hashed, unhashed_name
+
+
+DEFAULT_ENDPOINT = "https://s3.amazonaws.com"
+DEFAULT_REGION = "us-east-1"
+DEFAULT_UPLOAD_WORKERS = 8
+DEFAULT_LISTING_MAX_AGE = 60
+
+CONTENT_TYPES = {
+    ".css": "text/css",
+    ".js": "text/javascript",
+    ".png": "image/png",
+    ".gif": "image/gif",
+    ".svg": "image/svg+xml",
+    ".json": "application/json",
+}
+
+#Files smaller than this are kept in memory while their hash is worked out
+SPOOL_SIZE = 1024 * 1024
+
+#The most keys that a single DeleteObjects request may contain
+DELETE_BATCH_SIZE = 1000
+
+S3_NAMESPACE = "{http://s3.amazonaws.com/doc/2006-03-01/}"
+EMPTY_SHA256 = sha256("").hexdigest()
+
+
+def _quote(value, safe="/"):
+    #Python 2's quote() escapes "~", which AWS expects to be left alone
+    return urllib.quote(value, safe=safe + "~")
+
+
+def _hmac(key, message):
+    return hmac.new(key, message, sha256).digest()
+
+
+def sign_request(method, host, path, query, headers, payload_hash, access_key, secret_key, region, now):
+    """ Returns the Authorization header for the request, using AWS Signature Version 4.
+        headers must include x-amz-date and x-amz-content-sha256 (but not Host), and
+        query is a dict of the query string parameters.
+    """
+    all_headers = dict((name.lower(), " ".join(str(value).split())) for name, value in headers.items())
+    all_headers["host"] = host
+    signed_headers = ";".join(sorted(all_headers))
+
+    canonical_request = "\n".join([
+        method,
+        _quote(path),
+        "&".join("%s=%s" % (_quote(k, ""), _quote(v, "")) for k, v in sorted(query.items())),
+        "".join("%s:%s\n" % (name, all_headers[name]) for name in sorted(all_headers)),
+        signed_headers,
+        payload_hash,
+    ])
+
+    date = now.strftime("%Y%m%d")
+    scope = "/".join([date, region, "s3", "aws4_request"])
+    string_to_sign = "\n".join([
+        "AWS4-HMAC-SHA256", now.strftime("%Y%m%dT%H%M%SZ"), scope, sha256(canonical_request).hexdigest()
+    ])
+
+    key = "AWS4" + secret_key
+    for part in (date, region, "s3", "aws4_request"):
+        key = _hmac(key, part)
+
+    return "AWS4-HMAC-SHA256 Credential=%s/%s, SignedHeaders=%s, Signature=%s" % (
+        access_key, scope, signed_headers, hmac.new(key, string_to_sign, sha256).hexdigest()
+    )
+
+
+#Some S3-compatible stores leave the namespace out of their responses
+def _findall(element, name):
+    return element.findall(S3_NAMESPACE + name) + element.findall(name)
+
+
+def _find(element, name):
+    found = _findall(element, name)
+    return found[0] if found else None
+
+
+def _text(element, name, default=None):
+    child = _find(element, name)
+    return child.text if child is not None and child.text is not None else default
+
+
+class ConnectionPool(object):
+    """ Keeps up to size idle keep-alive connections to the endpoint for reuse. """
+
+    def __init__(self, endpoint, size):
+        parts = urlparse.urlsplit(endpoint)
+        self.secure = parts.scheme == "https"
+        self.host = parts.netloc
+        self.base_path = parts.path.rstrip("/")
+        self._idle = Queue.Queue(size)
+
+    def _connect(self):
+        connection_class = httplib.HTTPSConnection if self.secure else httplib.HTTPConnection
+        return connection_class(self.host)
+
+    def request(self, method, path, body=None, headers=None):
+        """ Makes the request, returning (status, headers, body). A connection which the
+            server has closed since it was last used is replaced and the request retried.
+        """
+        try:
+            connection = self._idle.get_nowait()
+            reused = True
+        except Queue.Empty:
+            connection = self._connect()
+            reused = False
+
+        while True:
+            try:
+                connection.request(method, self.base_path + path, body, headers or {})
+                response = connection.getresponse()
+                data = response.read()
+            except (httplib.HTTPException, socket.error):
+                connection.close()
+                if not reused:
+                    raise
+                connection = self._connect()
+                reused = False
+                if hasattr(body, "seek"):
+                    body.seek(0)
+                continue
+            break
+
+        if response.will_close:
+            connection.close()
+        else:
+            try:
+                self._idle.put_nowait(connection)
+            except Queue.Full:
+                connection.close()
+
+        return response.status, dict(response.getheaders()), data
+
+    def close(self):
+        while True:
+            try:
+                self._idle.get_nowait().close()
+            except Queue.Empty:
+                break
+
+
+class S3Client(object):
+    """ The handful of S3 operations which the outputter needs. If no access key is given,
+        requests aren't signed.
+    """
+
+    def __init__(self, endpoint, bucket, region=DEFAULT_REGION, access_key=None, secret_key=None, pool_size=DEFAULT_UPLOAD_WORKERS):
+        self.endpoint = endpoint.rstrip("/")
+        self.bucket = bucket
+        self.region = region
+        self.access_key = access_key
+        self.secret_key = secret_key
+        self.pool = ConnectionPool(self.endpoint, pool_size)
+
+    def object_url(self, key):
+        return "%s/%s/%s" % (self.endpoint, self.bucket, _quote(key))
+
+    def request(self, method, key="", query=None, headers=None, body=None, payload_hash="UNSIGNED-PAYLOAD"):
+        query = query or {}
+        headers = dict(headers or {})
+        path = "/%s/%s" % (self.bucket, key) if key else "/%s" % self.bucket
+
+        if self.access_key:
+            now = datetime.datetime.utcnow()
+            headers["x-amz-date"] = now.strftime("%Y%m%dT%H%M%SZ")
+            headers["x-amz-content-sha256"] = payload_hash
+            headers["Authorization"] = sign_request(
+                method, self.pool.host, self.pool.base_path + path, query, headers, payload_hash,
+                self.access_key, self.secret_key, self.region, now
+            )
+
+        url = _quote(path)
+        if query:
+            url += "?" + "&".join(
+                "%s=%s" % (_quote(k, ""), _quote(v, "")) if v else _quote(k, "") for k, v in sorted(query.items())
+            )
+
+        status, response_headers, data = self.pool.request(method, url, body, headers)
+        if status >= 300:
+            raise IOError("S3 %s %s failed with %d: %s" % (method, path, status, data[:500]))
+        return response_headers, data
+
+    def list_objects(self, prefix=""):
+        """ Returns a dict of key: (ETag, size, LastModified) for every object under prefix. """
+        objects = {}
+        query = {"list-type": "2", "prefix": prefix}
+        while True:
+            headers, data = self.request("GET", query=query, payload_hash=EMPTY_SHA256)
+            result = ElementTree.fromstring(data)
+            for item in _findall(result, "Contents"):
+                objects[_text(item, "Key")] = (
+                    _text(item, "ETag", "").strip('"'),
+                    int(_text(item, "Size", "0")),
+                    _text(item, "LastModified", ""),
+                )
+
+            if _text(result, "IsTruncated") != "true":
+                return objects
+            query = dict(query, **{"continuation-token": _text(result, "NextContinuationToken")})
+
+    def put_object(self, key, f, size, md5_digest, headers=None):
+        headers = dict(headers or {})
+        headers["Content-Length"] = str(size)
+        headers["Content-MD5"] = base64.b64encode(md5_digest)
+        self.request("PUT", key, headers=headers, body=f)
+
+    def delete_objects(self, keys):
+        """ Deletes the keys with as few DeleteObjects requests as possible. """
+        keys = list(keys)
+        for start in range(0, len(keys), DELETE_BATCH_SIZE):
+            body = "<Delete><Quiet>true</Quiet>%s</Delete>" % "".join(
+                "<Object><Key>%s</Key></Object>" % escape(key) for key in keys[start:start + DELETE_BATCH_SIZE]
+            )
+            headers = {
+                "Content-Type": "application/xml",
+                "Content-MD5": base64.b64encode(md5(body).digest()),
+            }
+            response_headers, data = self.request(
+                "POST", query={"delete": ""}, headers=headers, body=body, payload_hash=sha256(body).hexdigest()
+            )
+
+            errors = _findall(ElementTree.fromstring(data), "Error") if data else []
+            if errors:
+                raise IOError("Failed to delete %d object(s): %s" % (
+                    len(errors), ", ".join("%s (%s)" % (_text(e, "Key"), _text(e, "Code")) for e in errors)
+                ))
+
+
+def _spool(file_out):
+    """ Copies file_out to a temporary file (in memory if it's small), returning
+        (file, size, md5 digest), as the size and hash are needed before uploading.
+    """
+    f = tempfile.SpooledTemporaryFile(SPOOL_SIZE)
+    hasher = md5()
+    size = 0
+    for chunk in iter_chunks(file_out, CHUNK_SIZE):
+        hasher.update(chunk)
+        size += len(chunk)
+        f.write(chunk)
+    f.seek(0)
+    return f, size, hasher.digest()
+
+
+def _now():
+    """ Returns the current time in the format of LastModified in bucket listings. """
+    return datetime.datetime.utcnow().strftime("%Y-%m-%dT%H:%M:%S.%f")[:-3] + "Z"
+
+
+class BucketListing(object):
+    """ What's in a bucket under a prefix, shared by all of the outputters in the process
+        which upload there, so the bucket is listed once per build rather than once per
+        bundle. Uploads and deletes are applied to the listing as they're made, and the
+        bucket is only listed again once the listing is older than max_age seconds, in
+        case something else has changed it.
+    """
+    def __init__(self):
+        self.lock = threading.RLock()
+        self.objects = None #key: (ETag, size, LastModified)
+        self.listed_at = None
+
+    def get(self, client, prefix, max_age):
+        with self.lock:
+            if self.objects is None or time.time() - self.listed_at >= max_age:
+                self.objects = client.list_objects(prefix)
+                self.listed_at = time.time()
+            return self.objects
+
+    def clear(self):
+        with self.lock:
+            self.objects = None
+
+
+_listings = {}
+_listings_lock = threading.Lock()
+
+def get_bucket_listing(endpoint, bucket, prefix):
+    with _listings_lock:
+        key = (endpoint, bucket, prefix)
+        if key not in _listings:
+            _listings[key] = BucketListing()
+        return _listings[key]
+
+
+class S3(Outputter):
+    def __init__(self, directory=None, strip_path=None, bucket=None, keep_generations=None):
+        """ keep_generations is how many versions of each file to keep, see get_keep_generations(). """
+        super(S3, self).__init__(directory, strip_path)
+
+        bucket = bucket or getattr(settings, "ASSET_S3_BUCKET", None)
+        if not bucket:
+            raise ImproperlyConfigured("The 's3' outputter needs a bucket, set ASSET_S3_BUCKET.")
+
+        self.upload_workers = getattr(settings, "ASSET_S3_UPLOAD_WORKERS", DEFAULT_UPLOAD_WORKERS)
+        self.client = S3Client(
+            getattr(settings, "ASSET_S3_ENDPOINT", DEFAULT_ENDPOINT),
+            bucket,
+            region=getattr(settings, "ASSET_S3_REGION", DEFAULT_REGION),
+            access_key=getattr(settings, "ASSET_S3_ACCESS_KEY_ID", None),
+            secret_key=getattr(settings, "ASSET_S3_SECRET_ACCESS_KEY", None),
+            pool_size=self.upload_workers,
+        )
+
+        self.listing_max_age = getattr(settings, "ASSET_S3_LISTING_MAX_AGE", DEFAULT_LISTING_MAX_AGE)
+        self._keep_generations = keep_generations
+
+    @property
+    def keep_generations(self):
+        #Outputters are created while the settings are being loaded, so read them when needed
+        return get_keep_generations(self._keep_generations)
+
+    def get_key(self, filename):
+        """ Objects are stored under their path relative to STATIC_ROOT, which is the
+            same as the filenames that are served.
+        """
+        if filename.startswith(settings.STATIC_ROOT):
+            filename = filename[len(settings.STATIC_ROOT):]
+        return filename.lstrip("/")
+
+    def get_prefix(self):
+        prefix = self.get_key(self.directory or "")
+        if prefix:
+            prefix = prefix.rstrip("/") + "/"
+        return prefix
+
+    @property
+    def listing(self):
+        return get_bucket_listing(self.client.endpoint, self.client.bucket, self.get_prefix())
+
+    def refresh(self):
+        """ Lists the bucket again on next use, in case something else has changed it. """
+        self.listing.clear()
+
+    def _get_objects(self):
+        return self.listing.get(self.client, self.get_prefix(), self.listing_max_age)
+
+    def output_files(self, items):
+        """ Uploads the files on up to ASSET_S3_UPLOAD_WORKERS threads at once, then
+            deletes the versions of them which are no longer needed.
+        """
+        items = list(items)
+
+        def run(item):
+            try:
+                self.output(*item)
+            except Exception, e:
+                logging.exception("Failed to upload %s", item[0])
+                return e
+
+        workers = min(self.upload_workers, len(items))
+        if workers > 1:
+            pool = ThreadPool(workers)
+            try:
+                results = pool.map(run, items)
+            finally:
+                pool.close()
+                pool.join()
+        else:
+            results = map(run, items)
+
+        errors = [ "%s: %s" % (item[0], error) for item, error in zip(items, results) if error is not None ]
+        if errors:
+            raise ValueError("Failed to upload %d file(s):\n%s" % (len(errors), "\n".join(errors)))
+
+        self.remove_stale([ self.get_key(filename) for filename, file_out in items ])
+
+    def output(self, filename, file_out):
+        key = self.get_key(filename)
+        f, size, digest = _spool(file_out)
+        try:
+            existing = self._get_objects().get(key)
+            if existing and existing[:2] == (digest.encode("hex"), size):
+                logging.debug("Unchanged: %s", key)
+                return
+
+            logging.info("Uploading: %s", key)
+            headers = {
+                "Content-Type": CONTENT_TYPES.get(os.path.splitext(key)[1], "application/octet-stream"),
+                "Cache-Control": IMMUTABLE_CACHE_CONTROL if is_hashed(key) else REVALIDATE_CACHE_CONTROL,
+            }
+            self.client.put_object(key, f, size, digest, headers)
+        finally:
+            f.close()
+
+        with self.listing.lock:
+            self._get_objects()[key] = (digest.encode("hex"), size, _now())
+
+    def remove_stale(self, keys):
+        """ Deletes the other versions (i.e. with different hashes) of the given keys,
+            except for the most recently uploaded ones which are still kept.
+        """
+        keys = set(keys)
+        keep_generations = self.keep_generations
+
+        with self.listing.lock:
+            objects = self._get_objects()
+
+            #The number of current versions of each file, and the older ones newest first
+            current = {}
+            for key in keys:
+                name = unhashed_name(key)
+                current[name] = current.get(name, 0) + 1
+
+            older = dict((name, []) for name in current)
+            for key, (etag, size, modified) in objects.items():
+                name = unhashed_name(key)
+                if key not in keys and name in older:
+                    older[name].append((modified, key))
+
+            stale = []
+            for name, versions in older.items():
+                versions.sort(reverse=True)
+                stale.extend(key for modified, key in versions[max(0, keep_generations - current[name]):])
+
+        if not stale:
+            return
+
+        stale.sort()
+        logging.debug("Deleting: %s", ", ".join(stale))
+        self.client.delete_objects(stale)
+        with self.listing.lock:
+            objects = self._get_objects()
+            for key in stale:
+                objects.pop(key, None)
+
+    def file_up_to_date(self, filename):
+        return self.get_key(filename) in self._get_objects()
+
+    def serve(self, filename, request=None):
+        return HttpResponseRedirect(self.client.object_url(filename))
@@ -5,3 +5,5 @@ from .yui import YUI
 from .closure_compiler import ClosureCompiler
 from .prepend import Prepend
 from .append import Append
+from .cssmin import CSSMin
+from .jsmin import JSMin
@@ -1,32 +1,36 @@
 from collections import OrderedDict
-import ntpath
-import StringIO
 
 from ..base import Processor
+from ..buffers import FileBuffer, iter_chunks
 
 
 class Append(Processor):
+    cacheable = False #Concatenating is cheaper than caching
+    streaming = True
+
     def __init__(self, pipeline, additional_files):
         super(Append, self).__init__(pipeline)
         self.additional_files = additional_files
 
-    def process(self, inputs):
+    def stream(self, items):
         """
-            Concatenates the inputs into a single file
+            Concatenates the inputs into a single file, as they arrive
         """
-        output = StringIO.StringIO()
-
-        for filename, contents in inputs.items():
-            output.write(contents.read())
-            output.write("\n")
+        #The output is named after the last input. Listing them doesn't read their contents.
+        items = list(items)
 
-        for f in self.additional_files:
-            output.write(open(f).read())
-            output.write("\n")
+        def chunks():
+            for filename, file_chunks in items:
+                for chunk in file_chunks:
+                    yield chunk
+                yield "\n"
 
-        output.seek(0) #Rewind to the beginning
+            for f in self.additional_files:
+                for chunk in iter_chunks(FileBuffer(f)):
+                    yield chunk
+                yield "\n"
 
-        return OrderedDict([(filename, output)])
+        yield items[-1][0], chunks()
 
     def prepare(self, inputs):
         result = []
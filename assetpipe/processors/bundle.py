@@ -1,23 +1,25 @@
 from collections import OrderedDict
-import StringIO
 from ..base import Processor
 
 
 class Bundle(Processor):
+    cacheable = False #Concatenating is cheaper than caching
+    streaming = True
+
     def __init__(self, pipline, output_file_name):
         super(Bundle, self).__init__(pipline)
         self.output_file_name = output_file_name
 
-    def process(self, inputs):
+    def stream(self, items):
         """
-            Concatenates the inputs into a single file
+            Concatenates the inputs into a single file, as they arrive
         """
-        output = StringIO.StringIO()
-        for contents in inputs.values():
-            output.write(contents.read())
-            output.write("\n")
-        output.seek(0) #Rewind to the beginning
-        return OrderedDict([(self.output_file_name, output)])
+        def chunks():
+            for filename, file_chunks in items:
+                for chunk in file_chunks:
+                    yield chunk
+                yield "\n"
+        yield self.output_file_name, chunks()
 
     def prepare(self, inputs):
         return OrderedDict([(self.output_file_name, None)])
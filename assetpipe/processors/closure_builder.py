@@ -12,6 +12,17 @@ class ClosureBuilder(Processor):
         self.js_dirs = js_dirs or []
         self.inputs = inputs or []
 
+    def get_cache_key_parts(self):
+        return [ settings.CLOSURE_BUILDER_BINARY ]
+
+    def get_cache_dependencies(self, filenames):
+        #closurebuilder resolves goog.require()s by scanning the js_dirs
+        result = list(self.inputs)
+        for js_dir in self.js_dirs:
+            for root, dirnames, files in os.walk(js_dir):
+                result.extend(sorted(os.path.join(root, f) for f in files if f.endswith(".js")))
+        return result
+
     def process(self, inputs):
         """
             Runs the closurebuilder.py script to generate a single JS file.
@@ -1,14 +1,15 @@
-
-from collections import OrderedDict
 import os
 import StringIO
 from django.conf import settings
 from django.utils.encoding import smart_str
 import logging
-from ..base import Processor
+from ..base import Processor, CLOSE_FDS
+from ..workers import get_worker_pool
 from django.core.exceptions import ImproperlyConfigured
 
 class ClosureCompiler(Processor):
+    per_file = True
+
     def __init__(self, pipeline, language_in="ECMASCRIPT5_STRICT", *args, **kwargs):
         self.language_in = language_in
 
@@ -16,35 +17,39 @@ class ClosureCompiler(Processor):
 
         super(ClosureCompiler, self).__init__(pipeline, *args, **kwargs)
 
+    def get_cache_key_parts(self):
+        return [
+            getattr(settings, "CLOSURE_COMPILER_BINARY", ""),
+            repr(getattr(settings, "CLOSURE_COMPILER_WORKER", None))
+        ]
+
     def process(self, inputs):
-        if not hasattr(settings, "CLOSURE_COMPILER_BINARY"):
-            raise ImproperlyConfigured("Please set the CLOSURE_COMPILER_BINARY setting")
+        if not hasattr(settings, "CLOSURE_COMPILER_BINARY") and not hasattr(settings, "CLOSURE_COMPILER_WORKER"):
+            raise ImproperlyConfigured("Please set the CLOSURE_COMPILER_BINARY or CLOSURE_COMPILER_WORKER setting")
 
+        return self.process_files(inputs)
+
+    def process_file(self, filename, contents):
         from subprocess import Popen, PIPE
 
-        outputs = OrderedDict()
+        compressor = getattr(settings, "CLOSURE_COMPILER_BINARY", None)
+        args = [
+            "--language_in", self.language_in,
+            "--compilation_level", "SIMPLE_OPTIMIZATIONS"
+        ]
+        worker = getattr(settings, "CLOSURE_COMPILER_WORKER", None)
 
-        compressor = settings.CLOSURE_COMPILER_BINARY
         try:
-            for filename, contents in inputs.items():
-                cmd = Popen([
-                    'java', '-jar', compressor,
-                    "--language_in", self.language_in,
-                    "--compilation_level", "SIMPLE_OPTIMIZATIONS"
-                    ],
+            if worker:
+                status, output, error = get_worker_pool(worker).call(args, smart_str(contents.read()))
+            else:
+                cmd = Popen(
+                    ['java', '-jar', compressor] + args,
                     stdin=PIPE, stdout=PIPE, stderr=PIPE,
-                    universal_newlines=True
+                    universal_newlines=True, close_fds=CLOSE_FDS
                 )
                 output, error = cmd.communicate(smart_str(contents.read()))
-
-                if error:
-                    logging.warn(error)
-
-                file_out = StringIO.StringIO()
-                file_out.write(output)
-                file_out.seek(0)
-                outputs[filename] = file_out
-
+                status = cmd.returncode
         except Exception, e:
             raise ValueError("Failed to execute Java VM or closure. "
                     "Please make sure that you have installed Java "
@@ -52,4 +57,14 @@ class ClosureCompiler(Processor):
                     "CLOSURE_COMPILER_BINARY in your settings correctly.\n"
                     "Error was: %s" % e)
 
-        return outputs
+        #Closure writes warnings to stderr, so only a bad exit status is an error
+        if status != 0:
+            raise ValueError("Closure compiler returned exit status %d for %s:\n%s" % (status, filename, error))
+
+        if error:
+            logging.warn(error)
+
+        file_out = StringIO.StringIO()
+        file_out.write(output)
+        file_out.seek(0)
+        return filename, file_out
@@ -0,0 +1,93 @@
+from collections import OrderedDict
+import os
+import re
+import StringIO
+
+from ..base import Processor
+
+
+TOKEN = re.compile(r"""
+    (?P<comment>/\*[\s\S]*?\*/)
+  | (?P<string>"(?:\\[\s\S]|[^"\\\n])*"|'(?:\\[\s\S]|[^'\\\n])*')
+  | (?P<url>url\(\s*[^\s)"']*\s*\))
+  | (?P<space>\s+)
+  | (?P<word>[\w.#%-]+)
+  | (?P<other>[\s\S])
+""", re.VERBOSE | re.IGNORECASE)
+
+#Whitespace either side of these is never significant
+NO_SPACE_AROUND = "{};,>"
+
+LEADING_ZERO = re.compile(r"^(-?)0+\.(\d)")
+
+
+def minify_css(css):
+    """ Minifies css in a single pass over its tokens. Only transforms which are safe
+        regardless of context are applied: comments (other than /*! ... */) are removed,
+        whitespace is collapsed or removed where it isn't significant, the final ; of each
+        block is dropped and leading zeros are removed from decimals.
+    """
+    output = []
+    prev = "{" #Treat the start of the file like the start of a block
+    pending_space = False
+
+    for match in TOKEN.finditer(css):
+        kind = match.lastgroup
+        token = match.group()
+
+        if kind == "space":
+            pending_space = True
+            continue
+
+        if kind == "comment":
+            if token.startswith("/*!"):
+                output.append(token + "\n")
+                prev = "\n"
+                pending_space = False
+            else:
+                #Comments separate tokens just like whitespace
+                pending_space = True
+            continue
+
+        if kind == "word":
+            token = LEADING_ZERO.sub(r"\1.\2", token)
+        elif kind == "url":
+            token = "url(%s)" % token[4:-1].strip()
+
+        first = token[0]
+        if pending_space and not (
+            prev[-1] in NO_SPACE_AROUND or prev[-1] in ":(\n" or
+            first in NO_SPACE_AROUND or first in "!)"
+        ):
+            output.append(" ")
+        pending_space = False
+
+        if token == "}" and prev == ";":
+            output.pop()
+
+        output.append(token)
+        prev = token
+
+    return "".join(output).strip()
+
+
+class CSSMin(Processor):
+    """ Minifies CSS files in-process, without needing Java. Any other files are passed through. """
+    per_file = True
+
+    def process(self, inputs):
+        #This is CPU bound, so there's nothing to gain from process_files' threads
+        outputs = OrderedDict()
+        for filename, contents in inputs.items():
+            filename, file_out = self.process_file(filename, contents)
+            outputs[filename] = file_out
+        return outputs
+
+    def process_file(self, filename, contents):
+        if os.path.splitext(filename)[1] != ".css":
+            return filename, contents
+
+        file_out = StringIO.StringIO()
+        file_out.write(minify_css(contents.read()))
+        file_out.seek(0)
+        return filename, file_out
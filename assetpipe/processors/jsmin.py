@@ -0,0 +1,163 @@
+from collections import OrderedDict
+import os
+import re
+import StringIO
+
+from ..base import Processor
+
+
+SPACE = re.compile(r"\s+")
+LINE_COMMENT = re.compile(r"//[^\n]*")
+BLOCK_COMMENT = re.compile(r"/\*[\s\S]*?\*/")
+STRING = re.compile(r""""(?:\\[\s\S]|[^"\\\n])*"|'(?:\\[\s\S]|[^'\\\n])*'|`(?:\\[\s\S]|[^`\\])*`""")
+REGEX = re.compile(r"/(?:\\.|\[(?:\\.|[^\]\\\n])*\]|[^/\\\n\[])+/[a-zA-Z]*")
+WORD = re.compile(r"(?:[\w$\\]|[^\x00-\x7f])+")
+
+#A / after these starts a regular expression rather than being a division
+REGEX_AFTER_PUNCTUATION = "(,=:[!&|?{};~+-*%<>^"
+REGEX_AFTER_KEYWORDS = frozenset([
+    "return", "typeof", "case", "do", "else", "in", "instanceof",
+    "new", "delete", "void", "throw", "yield", "await",
+])
+
+#A line break between a token ending with one of these and a token starting
+#with one of these might be a statement boundary, so it has to be kept
+ASI_BEFORE = ")]}'\"`+-/"
+ASI_AFTER = "([{'\"`+-!~/"
+
+
+def _is_identifier_char(c):
+    return c.isalnum() or c in "$_\\" or ord(c) > 126
+
+
+def _separator(prev, token, newline):
+    """ Returns the whitespace (if any) which must be kept between prev and token. """
+    a = prev[-1]
+    b = token[0]
+
+    if newline and (_is_identifier_char(a) or a in ASI_BEFORE) and (_is_identifier_char(b) or b in ASI_AFTER):
+        return "\n"
+
+    if _is_identifier_char(a) and _is_identifier_char(b):
+        return " "
+
+    if (a in "+-" and b == a) or (a == "/" and b in "/*") or (prev.isdigit() and b == "."):
+        return " "
+
+    return ""
+
+
+def minify_js(js):
+    """ Minifies JavaScript in a single pass over its tokens, in the style of jsmin: comments
+        (other than /*! ... */) are removed and whitespace is removed wherever it isn't needed to
+        separate tokens. Line breaks which could be significant to automatic semicolon insertion
+        are kept. Identifiers are never renamed.
+    """
+    output = []
+    prev = "\n" #The last token written
+    last = None #The last token written which wasn't a preserved comment
+    before_last = None
+    pending = None #Whitespace skipped since the last token, None, " " or "\n"
+
+    pos = 0
+    length = len(js)
+    while pos < length:
+        c = js[pos]
+        match = None
+
+        if c.isspace():
+            match = SPACE.match(js, pos)
+            pending = "\n" if ("\n" in match.group() or pending == "\n") else " "
+            pos = match.end()
+            continue
+
+        if c == "/":
+            following = js[pos + 1:pos + 2]
+            if following == "/":
+                match = LINE_COMMENT.match(js, pos)
+                pending = "\n"
+                pos = match.end()
+                continue
+
+            if following == "*":
+                match = BLOCK_COMMENT.match(js, pos)
+                if not match:
+                    raise ValueError("Unterminated comment at character %d" % pos)
+
+                comment = match.group()
+                pos = match.end()
+                if comment.startswith("/*!"):
+                    if output and prev != "\n":
+                        output.append("\n")
+                    output.append(comment + "\n")
+                    prev = "\n"
+                    pending = None
+                elif "\n" in comment:
+                    pending = "\n"
+                elif pending is None:
+                    pending = " "
+                continue
+
+            regex_allowed = (
+                last is None or
+                (last in REGEX_AFTER_KEYWORDS) or
+                (not _is_identifier_char(last[-1]) and last[-1] in REGEX_AFTER_PUNCTUATION and
+                    #a++ / 2 is a division
+                    not (last in "+-" and before_last == last))
+            )
+            if regex_allowed:
+                match = REGEX.match(js, pos)
+                if not match:
+                    raise ValueError("Unterminated regular expression at character %d" % pos)
+
+        elif c in "\"'`":
+            match = STRING.match(js, pos)
+            if not match:
+                raise ValueError("Unterminated string at character %d" % pos)
+
+        elif _is_identifier_char(c):
+            match = WORD.match(js, pos)
+
+        if match:
+            token = match.group()
+            pos = match.end()
+        else:
+            token = c
+            pos += 1
+
+        if pending and output:
+            output.append(_separator(prev, token, pending == "\n"))
+        pending = None
+
+        output.append(token)
+        before_last = last
+        prev = last = token
+
+    return "".join(output).strip()
+
+
+class JSMin(Processor):
+    """ Minifies JavaScript files in-process, without needing Java. Any other files are passed through. """
+    per_file = True
+
+    def process(self, inputs):
+        #This is CPU bound, so there's nothing to gain from process_files' threads
+        outputs = OrderedDict()
+        for filename, contents in inputs.items():
+            filename, file_out = self.process_file(filename, contents)
+            outputs[filename] = file_out
+        return outputs
+
+    def process_file(self, filename, contents):
+        if os.path.splitext(filename)[1] != ".js":
+            return filename, contents
+
+        try:
+            content = minify_js(contents.read())
+        except ValueError, e:
+            raise ValueError("Failed to minify %s: %s" % (filename, e))
+
+        file_out = StringIO.StringIO()
+        file_out.write(content)
+        file_out.seek(0)
+        return filename, file_out
@@ -1,31 +1,34 @@
 from collections import OrderedDict
 import ntpath
-import StringIO
 
 from ..base import Processor
+from ..buffers import FileBuffer, iter_chunks
 
 
 class Prepend(Processor):
+    cacheable = False #Concatenating is cheaper than caching
+    streaming = True
+
     def __init__(self, pipeline, additional_files):
         super(Prepend, self).__init__(pipeline)
         self.additional_files = additional_files
 
-    def process(self, inputs):
+    def stream(self, items):
         """
-            Concatenates the inputs into a single file
+            Concatenates the inputs into a single file, as they arrive
         """
-        output = StringIO.StringIO()
-        for f in self.additional_files:
-            output.write(open(f).read())
-            output.write("\n")
-
-        for contents in inputs.values():
-            output.write(contents.read())
-            output.write("\n")
-
-        output.seek(0) #Rewind to the beginning
-
-        return OrderedDict([(ntpath.basename(f), output)])
+        def chunks():
+            for f in self.additional_files:
+                for chunk in iter_chunks(FileBuffer(f)):
+                    yield chunk
+                yield "\n"
+
+            for filename, file_chunks in items:
+                for chunk in file_chunks:
+                    yield chunk
+                yield "\n"
+
+        yield ntpath.basename(self.additional_files[-1]), chunks()
 
     def prepare(self, inputs):
         result = []
@@ -1,25 +1,138 @@
 from collections import OrderedDict
 import os
+import re
+import shutil
 import StringIO
 import logging
+import tempfile
 
-from ..base import Processor
+from ..base import Processor, CLOSE_FDS
 
 from django.conf import settings
 
+#sass --update appends a source map comment which stdin compiles don't have
+SOURCE_MAP_COMMENT = re.compile(r"\n?/\*# sourceMappingURL=.*?\*/\s*$")
+
+IMPORT_STATEMENT = re.compile(r"@import\s+([^;\n]+)")
+QUOTED = re.compile(r"\"([^\"]+)\"|'([^']+)'")
+COMMENT = re.compile(r"/\*[\s\S]*?\*/|//[^\n]*")
+
+
+class ImportGraph(object):
+    """ A cache of the files @imported by each SCSS/SASS file. A file is only re-parsed
+        when its mtime changes, so finding all of the partials used by a stylesheet costs
+        a stat per partial, rather than having to declare (and stat) every file which
+        could possibly be imported as a dependency of the pipeline.
+    """
+
+    def __init__(self, include_paths):
+        self.include_paths = list(include_paths)
+        #path: (mtime, [resolved paths of direct imports])
+        self._imports = {}
+
+    def get_imports(self, filenames):
+        """ Returns the sorted list of all the files imported, directly or indirectly,
+            by the given files (not including the files themselves).
+        """
+        roots = set(os.path.normpath(x) for x in filenames)
+        seen = set()
+        to_visit = list(roots)
+        while to_visit:
+            path = to_visit.pop()
+            if path in seen:
+                continue
+            seen.add(path)
+            to_visit.extend(self._direct_imports(path))
+
+        return sorted(seen - roots)
+
+    def _direct_imports(self, path):
+        try:
+            mtime = os.path.getmtime(path)
+        except OSError:
+            return []
+
+        cached = self._imports.get(path)
+        if cached and cached[0] == mtime:
+            return cached[1]
+
+        with open(path, "r") as f:
+            names = self.parse_imports(f.read(), indented=path.endswith(".sass"))
+
+        directory = os.path.dirname(path)
+        imports = []
+        for name in names:
+            resolved = self.resolve(name, directory)
+            if resolved:
+                imports.append(resolved)
+            else:
+                #Probably a Compass/gem import, which doesn't change between builds
+                logging.debug("Unable to resolve @import '%s' in %s", name, path)
+
+        self._imports[path] = (mtime, imports)
+        return imports
+
+    def parse_imports(self, source, indented=False):
+        """ Returns the names of the SASS files imported by source, ignoring plain CSS imports. """
+        source = COMMENT.sub("", source)
+
+        names = []
+        for statement in IMPORT_STATEMENT.findall(source):
+            if indented:
+                parts = [ x.strip().strip("\"'") for x in statement.split(",") ]
+            else:
+                parts = [ a or b for a, b in QUOTED.findall(statement) ]
+
+            for name in parts:
+                if not name or name.endswith(".css") or "://" in name or name.startswith("url("):
+                    continue
+                names.append(name)
+        return names
+
+    def resolve(self, name, directory):
+        """ Finds the file which sass would load for @import "name" in a file in directory. """
+        dirname, basename = os.path.split(name)
+        if os.path.splitext(basename)[1] in (".scss", ".sass"):
+            extensions = [ "" ]
+        else:
+            extensions = [ ".scss", ".sass" ]
+
+        for base in [ directory ] + self.include_paths + [ "." ]:
+            for prefix in ("", "_"):
+                for ext in extensions:
+                    path = os.path.join(base, dirname, prefix + basename + ext)
+                    if os.path.isfile(path):
+                        return os.path.normpath(path)
+        return None
+
+
+_import_graphs = {}
+
+def get_import_graph(include_paths):
+    key = tuple(include_paths)
+    if key not in _import_graphs:
+        _import_graphs[key] = ImportGraph(include_paths)
+    return _import_graphs[key]
+
+
 class SCSS(Processor):
-    def __init__(self, pipeline, use_compass=False, debug=False, compressed=False, *args, **kwargs):
+    per_file = True
+
+    def __init__(self, pipeline, use_compass=False, debug=False, compressed=False, batch=False, *args, **kwargs):
+        """ If batch is True, all of the files are compiled by a single sass process, so that
+            Ruby (and Compass) only has to be loaded once.
+        """
         super(SCSS, self).__init__(pipeline, *args, **kwargs)
         self.debug = debug
         self.use_compass = use_compass
         self.compressed = compressed
+        self.batch = batch
 
-    def process(self, inputs):
-        from subprocess import Popen, PIPE
-
-        outputs = OrderedDict()
-
-        sass_path = settings.SASS_COMPILER_BINARY
+    def get_command(self, stdin=True):
+        """ Returns the sass command line, which depends on the settings. If stdin is
+            False, the options are the same but sass won't read from stdin.
+        """
+        sass_path = getattr(settings, "SASS_COMPILER_BINARY", "")
 
         command = [ "ruby" ]
 
@@ -29,7 +142,9 @@ class SCSS(Processor):
 
         command.append(sass_path.strip())
         css_style = "compressed" if self.compressed else "expanded"
-        command.extend(["-C", "-t", css_style, "-s"])
+        command.extend(["-C", "-t", css_style])
+        if stdin:
+            command.append("-s")
 
         if self.use_compass:
             command.append("--compass")
@@ -47,34 +162,121 @@ class SCSS(Processor):
         if self.debug:
             command.append("--debug-info")
 
+        return command
+
+    def get_cache_key_parts(self):
+        return self.get_command()
+
+    def get_dependencies(self, filenames):
+        #SASS reads any @imported partials from disk
+        include_paths = getattr(settings, "SASS_ADDITIONAL_INCLUDE_PATHS", [])
+        return get_import_graph(include_paths).get_imports(filenames)
+
+    def get_cache_dependencies(self, filenames):
+        #Some imports can't be resolved by the import graph (e.g. sass-globbing, or
+        #"#{$var}"), so anything declared as a dependency of the pipeline has to be
+        #part of the key as well. The pipeline expands them when it's prepared.
+        result = set(self.get_dependencies(filenames))
+        result.update(getattr(self.pipeline, "dependency_files", []))
+        return sorted(result)
+
+    def prepare(self, inputs):
+        result = OrderedDict()
+        for filename, contents in inputs.items():
+            f, ext = os.path.splitext(filename)
+            result[filename if ext == ".css" else "%s.css" % f] = contents
+        return result
+
+    def process(self, inputs):
+        to_compile = [ x for x in inputs.keys() if os.path.splitext(x)[1] != ".css" ]
+        if self.batch and len(to_compile) > 1:
+            try:
+                return self.process_batch(inputs)
+            except ValueError, e:
+                #Compile each file on its own so that the errors are reported per file
+                logging.warn("Batch SASS compile failed, compiling files individually: %s", e)
+
+        return self.process_files(inputs)
+
+    def process_batch(self, inputs):
+        """ Compiles all of the inputs with a single `sass --update in:out in:out ...` into a
+            temporary directory, then reads the results back in input order.
+        """
+        from subprocess import Popen, PIPE
+
+        output_dir = tempfile.mkdtemp()
         try:
-            for filename, contents in inputs.items():
-                #Ignore CSS files, they don't need compiling
-                f, ext = os.path.splitext(filename)
-                if ext == ".css":
-                    outputs[filename] = contents
+            command = self.get_command(stdin=False) + ["--update", "--force", "--stop-on-error"]
+
+            targets = {}
+            for i, filename in enumerate(inputs.keys()):
+                if os.path.splitext(filename)[1] == ".css":
                     continue
 
+                targets[filename] = os.path.join(output_dir, "%d.css" % i)
+                command.append("%s:%s" % (filename.replace("\\", "/"), targets[filename]))
+
+            try:
                 cmd = Popen(
                     command,
                     stdin=PIPE, stdout=PIPE, stderr=PIPE,
-                    universal_newlines=True
+                    universal_newlines=True, close_fds=CLOSE_FDS
                 )
+                output, error = cmd.communicate()
+            except Exception, e:
+                raise ValueError("Failed to execute Ruby or SASS. "
+                        "Please make sure that you have installed Ruby "
+                        "and that it's in your PATH and that you've configured "
+                        "SASS_COMPILER_BINARY in your settings correctly.\n"
+                        "Error was: %s" % e)
 
-                filename = filename.replace("\\", "/")
-                output, error = cmd.communicate('@import "%s"' % filename)
+            if cmd.returncode != 0:
+                raise ValueError('Command returned bad result:\n%s%s' % (output, error))
 
-                if error:
-                    logging.warn(error)
+            if error:
+                logging.warn(error)
 
-                assert cmd.wait() == 0, 'Command returned bad result:\n%s' % error
+            outputs = OrderedDict()
+            for filename, contents in inputs.items():
+                if filename not in targets:
+                    outputs[filename] = contents
+                    continue
+
+                with open(targets[filename], "r") as f:
+                    content = SOURCE_MAP_COMMENT.sub("\n", f.read())
 
                 file_out = StringIO.StringIO()
-                file_out.write(output)
+                file_out.write(content)
                 file_out.seek(0)
                 #alter the filename to change the .scss extension to .css now that we've compiled it
-                filename = "%s.css" % f
-                outputs[filename] = file_out
+                outputs["%s.css" % os.path.splitext(filename)[0]] = file_out
+
+            return outputs
+        finally:
+            shutil.rmtree(output_dir, ignore_errors=True)
+
+    def process_file(self, filename, contents):
+        from subprocess import Popen, PIPE
+
+        #Ignore CSS files, they don't need compiling
+        f, ext = os.path.splitext(filename)
+        if ext == ".css":
+            return filename, contents
+
+        try:
+            cmd = Popen(
+                self.get_command(),
+                stdin=PIPE, stdout=PIPE, stderr=PIPE,
+                universal_newlines=True, close_fds=CLOSE_FDS
+            )
+
+            filename = filename.replace("\\", "/")
+            output, error = cmd.communicate('@import "%s"' % filename)
+
+            if error:
+                logging.warn(error)
+
+            assert cmd.wait() == 0, 'Command returned bad result:\n%s' % error
 
         except Exception, e:
             raise ValueError("Failed to execute Ruby or SASS. "
@@ -82,4 +284,9 @@ class SCSS(Processor):
                     "and that it's in your PATH and that you've configured "
                     "SASS_COMPILER_BINARY in your settings correctly.\n"
                     "Error was: %s" % e)
-        return outputs
+
+        file_out = StringIO.StringIO()
+        file_out.write(output)
+        file_out.seek(0)
+        #alter the filename to change the .scss extension to .css now that we've compiled it
+        return "%s.css" % f, file_out
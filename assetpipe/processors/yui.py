@@ -1,10 +1,10 @@
 
-from collections import OrderedDict
 import os
 import StringIO
 from django.conf import settings
 from django.utils.encoding import smart_str
-from ..base import Processor
+from ..base import Processor, CLOSE_FDS
+from ..workers import get_worker_pool
 
 
 ERROR_STRING = ("Failed to execute Java VM or yuicompressor. "
@@ -15,32 +15,45 @@ ERROR_STRING = ("Failed to execute Java VM or yuicompressor. "
 
 
 class YUI(Processor):
+    per_file = True
+
+    def get_cache_key_parts(self):
+        return [
+            getattr(settings, "YUI_COMPRESSOR_BINARY", ""),
+            repr(getattr(settings, "YUI_COMPRESSOR_WORKER", None))
+        ]
+
     def process(self, inputs):
+        return self.process_files(inputs)
+
+    def process_file(self, filename, contents):
         from subprocess import Popen, PIPE
 
-        outputs = OrderedDict()
+        compressor = getattr(settings, "YUI_COMPRESSOR_BINARY", None)
+        filetype = os.path.splitext(filename)[-1].lstrip(".")
 
-        compressor = settings.YUI_COMPRESSOR_BINARY
-        for filename, contents in inputs.items():
-            filetype = os.path.splitext(filename)[-1].lstrip(".")
+        args = ['--charset', 'utf-8', '--type', filetype]
+        worker = getattr(settings, "YUI_COMPRESSOR_WORKER", None)
 
-            try:
-                cmd = Popen([
-                    'java', '-jar', compressor,
-                    '--charset', 'utf-8', '--type', filetype],
+        try:
+            if worker:
+                status, output, error = get_worker_pool(worker).call(args, smart_str(contents.read()))
+                if status != 0 and not error:
+                    error = "Worker returned exit status %d" % status
+            else:
+                cmd = Popen(
+                    ['java', '-jar', compressor] + args,
                     stdin=PIPE, stdout=PIPE, stderr=PIPE,
-                    universal_newlines=True
+                    universal_newlines=True, close_fds=CLOSE_FDS
                 )
                 output, error = cmd.communicate(smart_str(contents.read()))
-            except Exception, e:
-                raise ValueError(ERROR_STRING % e)
-
-            if error != '':
-                raise ValueError(ERROR_STRING % error)
+        except Exception, e:
+            raise ValueError(ERROR_STRING % e)
 
-            file_out = StringIO.StringIO()
-            file_out.write(output)
-            file_out.seek(0)
-            outputs[filename] = file_out
+        if error != '':
+            raise ValueError(ERROR_STRING % error)
 
-        return outputs
+        file_out = StringIO.StringIO()
+        file_out.write(output)
+        file_out.seek(0)
+        return filename, file_out
@@ -0,0 +1,154 @@
+""" Runs all of the bundles of a pipeline, optionally in separate worker processes.
+
+    Bundles are independent unless their Gather() declares that it `requires`
+    other bundles, in which case it is only started once those have finished.
+"""
+import time
+import logging
+import traceback
+import multiprocessing
+
+
+class BundleFailed(Exception):
+    def __init__(self, bundle_name, error):
+        super(BundleFailed, self).__init__("Bundle '%s' failed:\n%s" % (bundle_name, error))
+        self.bundle_name = bundle_name
+        self.error = error
+
+
+def get_bundle_requirements(bundles):
+    """ Returns a dictionary of bundle_name: set(names of bundles which must be run first). """
+    result = {}
+    for name, pipeline in bundles.items():
+        requires = set(getattr(pipeline.head, "requires", []))
+        unknown = requires - set(bundles.keys())
+        if unknown:
+            raise ValueError("Bundle '%s' requires unknown bundle(s): %s" % (name, ", ".join(sorted(unknown))))
+        result[name] = requires
+    return result
+
+
+def _run_bundle(pipeline_name, bundle_name):
+    """ Runs a single bundle, this is called in the worker processes so must not raise. """
+    from django.conf import settings
+
+    try:
+        pipeline = settings.ASSET_PIPELINES[pipeline_name][bundle_name]
+        pipeline.run()
+        return bundle_name, pipeline.output_urls(), None
+    except Exception:
+        return bundle_name, None, traceback.format_exc()
+
+
+def _run_bundle_process(connection, pipeline_name, bundle_name):
+    """ The target of each worker process, sends the result back over connection. """
+    connection.send(_run_bundle(pipeline_name, bundle_name))
+    connection.close()
+
+
+class BundleProcess(object):
+    """ Runs a bundle in its own process, so that if the process dies (e.g. it runs out
+        of memory) we know which bundle it was running.
+    """
+    def __init__(self, pipeline_name, bundle_name):
+        self.bundle_name = bundle_name
+        self.connection, child_connection = multiprocessing.Pipe(False)
+        self.process = multiprocessing.Process(
+            target=_run_bundle_process, args=(child_connection, pipeline_name, bundle_name)
+        )
+        self.process.daemon = True
+        self.process.start()
+        #Only the child has the sending end open, so reads see EOF if it dies
+        child_connection.close()
+
+    def result(self):
+        """ Returns the result of _run_bundle, or None if it's still running. """
+        if not self.connection.poll():
+            if self.process.is_alive():
+                return None
+            #It may have sent the result just before exiting
+            if not self.connection.poll():
+                return self._died()
+
+        try:
+            result = self.connection.recv()
+        except EOFError:
+            return self._died()
+        self.process.join()
+        return result
+
+    def _died(self):
+        self.process.join()
+        return self.bundle_name, None, "The worker process exited with code %s" % self.process.exitcode
+
+    def terminate(self):
+        if self.process.is_alive():
+            self.process.terminate()
+        self.process.join()
+
+
+def run_bundles(pipeline_name, jobs=1):
+    """ Runs every bundle in settings.ASSET_PIPELINES[pipeline_name], up to `jobs` at a time, and
+        returns a dictionary of bundle_name: output_urls. Raises BundleFailed as soon as any bundle
+        fails, without starting any more.
+    """
+    from django.conf import settings
+
+    pending = get_bundle_requirements(settings.ASSET_PIPELINES[pipeline_name])
+    results = {}
+
+    def pop_ready():
+        ready = sorted(name for name, requires in pending.items() if requires.issubset(results))
+        for name in ready:
+            del pending[name]
+        return ready
+
+    def check_cycle():
+        raise ValueError("Bundles have circular requirements: %s" % ", ".join(sorted(pending.keys())))
+
+    def collect(result):
+        bundle_name, urls, error = result
+        if error is not None:
+            raise BundleFailed(bundle_name, error)
+        logging.info("Generated bundle %s", bundle_name)
+        results[bundle_name] = urls
+
+    if jobs <= 1:
+        while pending:
+            ready = pop_ready()
+            if not ready:
+                check_cycle()
+            for bundle_name in ready:
+                collect(_run_bundle(pipeline_name, bundle_name))
+        return results
+
+    ready = []
+    running = []
+    try:
+        while pending or ready or running:
+            ready.extend(pop_ready())
+            while ready and len(running) < jobs:
+                running.append(BundleProcess(pipeline_name, ready.pop(0)))
+
+            if not running:
+                check_cycle()
+
+            finished = []
+            while not finished:
+                for process in running:
+                    result = process.result()
+                    if result is not None:
+                        finished.append((process, result))
+                if not finished:
+                    #Poll rather than block, so that KeyboardInterrupt still gets through
+                    time.sleep(0.05)
+
+            for process, result in finished:
+                running.remove(process)
+                collect(result)
+    except:
+        for process in running:
+            process.terminate()
+        raise
+
+    return results
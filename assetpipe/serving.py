@@ -0,0 +1,197 @@
+""" Builds the responses for the outputters' serve() methods, with caching headers,
+    conditional GETs (304 Not Modified) and single byte range requests.
+
+    File contents are streamed in chunks rather than read into memory. Wrap the WSGI
+    application in assetpipe.wsgi.FileWrapperMiddleware to have the server send whole files
+    with wsgi.file_wrapper (i.e. sendfile) instead.
+"""
+import os
+import re
+
+from django.http import HttpResponse, HttpResponseNotModified
+try:
+    #Django 1.5+, which doesn't read the content into memory when middleware looks at it
+    from django.http import StreamingHttpResponse
+except ImportError:
+    StreamingHttpResponse = HttpResponse
+from django.utils.http import http_date, parse_http_date_safe
+
+from .buffers import CHUNK_SIZE
+
+#Filenames which contain the pipeline or content hash (see OutputNode._add_hash_to_filename) never change
+HASHED_FILENAME = re.compile(r"\.[0-9a-f]{32}\.[^./]+$")
+
+RANGE = re.compile(r"^bytes=(\d*)-(\d*)$")
+
+IMMUTABLE_CACHE_CONTROL = "public, max-age=31536000, immutable"
+REVALIDATE_CACHE_CONTROL = "no-cache"
+
+
+def is_hashed(filename):
+    return HASHED_FILENAME.search(filename) is not None
+
+
+def unhashed_name(filename):
+    """ Returns filename with the hash taken out, which is the same for every version of a file. """
+    match = HASHED_FILENAME.search(filename)
+    if match is None:
+        return filename
+    return filename[:match.start()] + os.path.splitext(filename)[1]
+
+
+def accepted_encodings(request):
+    """ Returns the set of content codings which the request's Accept-Encoding allows. """
+    result = set()
+    for part in request.META.get("HTTP_ACCEPT_ENCODING", "").split(","):
+        params = part.split(";")
+        coding = params[0].strip().lower()
+
+        quality = 1.0
+        for param in params[1:]:
+            name, _, value = param.partition("=")
+            if name.strip() == "q":
+                try:
+                    quality = float(value)
+                except ValueError:
+                    quality = 0
+
+        if coding and quality > 0:
+            result.add(coding)
+    return result
+
+
+def _etag_matches(header, etag):
+    if header.strip() == "*":
+        return True
+    return etag in [ x.strip() for x in header.split(",") ]
+
+
+def not_modified(request, etag, last_modified):
+    """ Returns True if the client's cached copy (according to the request's conditional
+        headers) is still current.
+    """
+    if_none_match = request.META.get("HTTP_IF_NONE_MATCH")
+    if if_none_match is not None:
+        #If-Modified-Since is ignored when If-None-Match is given
+        return _etag_matches(if_none_match, etag)
+
+    if_modified_since = request.META.get("HTTP_IF_MODIFIED_SINCE")
+    if if_modified_since is not None:
+        since = parse_http_date_safe(if_modified_since.split(";")[0])
+        return since is not None and int(last_modified) <= since
+
+    return False
+
+
+def parse_range(request, etag, last_modified, size):
+    """ Returns the (start, end) (inclusive) of the byte range requested, None if the whole
+        file should be sent, or False if the range can't be satisfied. Only single ranges are
+        supported, for anything else the whole file is sent.
+    """
+    header = request.META.get("HTTP_RANGE")
+    if not header:
+        return None
+
+    if_range = request.META.get("HTTP_IF_RANGE")
+    if if_range:
+        if if_range.startswith('"'):
+            if if_range != etag:
+                return None
+        elif parse_http_date_safe(if_range) != int(last_modified):
+            return None
+
+    match = RANGE.match(header.strip())
+    if not match or match.groups() == ("", ""):
+        return None
+
+    first, last = match.groups()
+    if first:
+        start = int(first)
+        end = min(int(last), size - 1) if last else size - 1
+        if start >= size or end < start:
+            return False
+    else:
+        #A suffix range, i.e. the last N bytes
+        length = int(last)
+        if not length:
+            return False
+        start = max(size - length, 0)
+        end = size - 1
+
+    return start, end
+
+
+class FileChunks(object):
+    """ Iterates over length bytes of the file-like object f from its current position,
+        a chunk at a time. The file is closed when the response is.
+    """
+
+    def __init__(self, f, length):
+        self.file = f
+        self.length = length
+        #Set once anything (e.g. middleware rewriting the content) has started reading
+        self.started = False
+
+    def __iter__(self):
+        self.started = True
+        remaining = self.length
+        while remaining > 0:
+            chunk = self.file.read(min(CHUNK_SIZE, remaining))
+            if not chunk:
+                break
+            remaining -= len(chunk)
+            yield chunk
+
+    def close(self):
+        self.file.close()
+
+
+def file_response(request, filename, open_file, size, last_modified, etag, content_type, content_encoding=None):
+    """ Returns a response for the file, where open_file() returns a file-like object of
+        its contents, last_modified is a timestamp and etag is a quoted strong ETag.
+        If there's no request, the whole file is always sent.
+    """
+    headers = {
+        "ETag": etag,
+        "Last-Modified": http_date(last_modified),
+        "Cache-Control": IMMUTABLE_CACHE_CONTROL if is_hashed(filename) else REVALIDATE_CACHE_CONTROL,
+        "Accept-Ranges": "bytes",
+    }
+
+    byte_range = None
+    if request is not None:
+        if not_modified(request, etag, last_modified):
+            response = HttpResponseNotModified()
+            for header in ("ETag", "Last-Modified", "Cache-Control"):
+                response[header] = headers[header]
+            return response
+
+        byte_range = parse_range(request, etag, last_modified, size)
+
+    if byte_range is False:
+        response = HttpResponse(status=416)
+        response["Content-Range"] = "bytes */%d" % size
+        return response
+
+    f = open_file()
+    if byte_range is None:
+        chunks = FileChunks(f, size)
+        response = StreamingHttpResponse(chunks, content_type=content_type)
+        response["Content-Length"] = str(size)
+        #For FileWrapperMiddleware, which has to check that other middleware hasn't
+        #replaced the content (e.g. GZipMiddleware) before sending the file itself
+        response.file_to_stream = f
+        response.file_chunks = chunks
+        response.file_encoding = content_encoding
+    else:
+        start, end = byte_range
+        f.seek(start)
+        response = StreamingHttpResponse(FileChunks(f, end - start + 1), content_type=content_type, status=206)
+        response["Content-Range"] = "bytes %d-%d/%d" % (start, end, size)
+        response["Content-Length"] = str(end - start + 1)
+
+    for header, value in headers.items():
+        response[header] = value
+    if content_encoding:
+        response["Content-Encoding"] = content_encoding
+    return response
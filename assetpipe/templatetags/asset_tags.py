@@ -1,24 +1,44 @@
 import os
 from django import template
 from django.conf import settings
-from assetpipe.base import read_generated_media_file
+from assetpipe.builds import run_pipeline
+from assetpipe.manifest import get_manifest_cache
 
 IN_TESTING = getattr(settings, 'IN_TESTING', False)
 
 register = template.Library()
 
 
+def render_tags(outputs):
+    tags = []
+    for output in outputs:
+        if output.endswith(".css"):
+            tag = u'<link rel="stylesheet" type="text/css" href="%s" />' % os.path.join(settings.STATIC_URL, output)
+        elif output.endswith(".js"):
+            tag = u'<script src="%s"></script>' % os.path.join(settings.STATIC_URL, output)
+        else:
+            raise ValueError("Invalid output found")
+        tags.append(tag)
+    return '\n'.join(tags)
+
+def render_url(outputs):
+    if len(outputs) > 1:
+        raise ValueError("Tried to access URL of a pipeline with multiple outputs")
+
+    if outputs:
+        return outputs[0]
+    return ""
+
+
 class AssetNode(template.Node):
     def __init__(self, pipeline_name):
         self.pipeline_name = pipeline_name
-        self._generated_cache = None
 
     def render(self, context):
         if IN_TESTING:
             return ''
 
         pipeline_name = template.Variable(self.pipeline_name).resolve(context)
-        tags = []
 
         if settings.ASSET_DEV_MODE:
             active = settings.ASSET_PIPELINE_ACTIVE
@@ -28,23 +48,12 @@ class AssetNode(template.Node):
                 raise template.TemplateSyntaxError(
                     "Pipeline with name %s not defined in settings.ASSET_PIPELINES." % pipeline_name
                 )
-            outputs = pipeline.output_urls()
-        else:
-            #On live, we used the generated media file
-            if self._generated_cache is None:
-                self._generated_cache = read_generated_media_file()
-
-            outputs = self._generated_cache[pipeline_name]
-
-        for output in outputs:
-            if output.endswith(".css"):
-                tag = u'<link rel="stylesheet" type="text/css" href="%s" />' % os.path.join(settings.STATIC_URL, output)
-            elif output.endswith(".js"):
-                tag = u'<script src="%s"></script>' % os.path.join(settings.STATIC_URL, output)
-            else:
-                raise ValueError("Invalid output found")
-            tags.append(tag)
-        return '\n'.join(tags)
+            #The middleware only builds bundles when they're requested, so make sure
+            #the URLs we output are up to date
+            return render_tags(run_pipeline(pipeline))
+
+        #On live, we use the generated media file
+        return get_manifest_cache().get_rendered("include_assets", pipeline_name, render_tags)
 
 @register.tag
 def include_assets(parser, token):
@@ -62,7 +71,6 @@ def include_assets(parser, token):
 class AssetURLNode(template.Node):
     def __init__(self, pipeline_name):
         self.pipeline_name = pipeline_name
-        self._generated_cache = None
 
     def render(self, context):
         if IN_TESTING:
@@ -78,20 +86,12 @@ class AssetURLNode(template.Node):
                 raise template.TemplateSyntaxError(
                     "Pipeline with name %s not defined in settings.ASSET_PIPELINES." % pipeline_name
                 )
-            outputs = pipeline.output_urls()
-        else:
-            #On live, we used the generated media file
-            if self._generated_cache is None:
-                self._generated_cache = read_generated_media_file()
-
-            outputs = self._generated_cache[pipeline_name]
-
-        if len(outputs) > 1:
-            raise ValueError("Tried to access URL of a pipeline with multiple outputs")
+            #The middleware only builds bundles when they're requested, so make sure
+            #the URLs we output are up to date
+            return render_url(run_pipeline(pipeline))
 
-        if outputs:
-            return outputs[0]
-        return ""
+        #On live, we use the generated media file
+        return get_manifest_cache().get_rendered("asset_url", pipeline_name, render_url)
 
 @register.tag
 def asset_url(parser, token):
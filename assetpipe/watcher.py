@@ -0,0 +1,267 @@
+""" Watches the files used by each pipeline, so that the middleware doesn't have to glob
+    and stat every input and dependency on every request to find out that nothing changed.
+
+    The watcher keeps a dirty flag per pipeline. A pipeline starts off dirty, and is marked
+    dirty again whenever anything changes in the directories it reads from. Enable it with
+    the ASSET_WATCHER setting.
+"""
+import os
+import sys
+import time
+import errno
+import struct
+import logging
+import threading
+
+try:
+    import ctypes
+    import ctypes.util
+
+    _libc = ctypes.CDLL(ctypes.util.find_library("c") or "libc.so.6", use_errno=True)
+    HAVE_INOTIFY = sys.platform.startswith("linux") and hasattr(_libc, "inotify_init")
+except (ImportError, OSError):
+    HAVE_INOTIFY = False
+
+
+class Watcher(object):
+    def __init__(self):
+        self._lock = threading.Lock()
+        self._dirty = {}
+        self._paths = {}
+
+    def is_dirty(self, key):
+        return self._dirty.get(key, True)
+
+    def mark_dirty(self, key):
+        self._dirty[key] = True
+
+    def clear(self, key):
+        self._dirty[key] = False
+
+    def watch(self, key, paths):
+        """ Sets the (directory, recursive) pairs that key depends on. """
+        with self._lock:
+            self._paths[key] = set(paths)
+
+    def run(self, pipeline):
+        """ Runs the pipeline if anything it depends on has changed since it last ran. """
+        head = pipeline.head
+        if not self.is_dirty(head):
+            return
+
+        #Clear the flag and start watching first, so that changes made while the
+        #pipeline is running mean it's run again next time
+        self.clear(head)
+        try:
+            head.prepare()
+            self.watch(head, head.get_watched_paths())
+        except:
+            self.mark_dirty(head)
+            raise
+
+        #If this fails, there's no point running it again until something has changed
+        pipeline.run()
+
+    def _keys_watching(self, path):
+        """ Returns the keys which depend on a change to path. """
+        result = set()
+        with self._lock:
+            for key, paths in self._paths.items():
+                for directory, recursive in paths:
+                    if path == directory or (recursive and path.startswith(directory.rstrip(os.sep) + os.sep)):
+                        result.add(key)
+                        break
+        return result
+
+
+class PollingWatcher(Watcher):
+    """ Re-scans the watched directories on a background thread every `interval` seconds.
+        This still stats every file, but not while a request is waiting for it.
+    """
+
+    def __init__(self, interval=1):
+        super(PollingWatcher, self).__init__()
+        self.interval = interval
+        self._snapshots = {}
+
+        thread = threading.Thread(target=self._poll)
+        thread.daemon = True
+        thread.start()
+
+    def watch(self, key, paths):
+        super(PollingWatcher, self).watch(key, paths)
+        try:
+            self._snapshots[key] = self._snapshot(paths)
+        except OSError:
+            logging.exception("Unable to scan watched directories")
+
+    def _snapshot(self, paths):
+        result = {}
+        for directory, recursive in paths:
+            if not os.path.isdir(directory):
+                continue
+
+            if recursive:
+                walker = os.walk(directory, followlinks=True)
+            else:
+                walker = [ (directory, [], os.listdir(directory)) ]
+
+            for root, dirnames, filenames in walker:
+                for filename in filenames:
+                    path = os.path.join(root, filename)
+                    try:
+                        result[path] = os.path.getmtime(path)
+                    except OSError:
+                        continue
+        return result
+
+    def check(self):
+        """ Compares every key's files with the last snapshot, marking changed keys dirty. """
+        with self._lock:
+            watched = self._paths.items()
+
+        for key, paths in watched:
+            try:
+                snapshot = self._snapshot(paths)
+            except OSError:
+                logging.exception("Unable to scan watched directories")
+                continue
+
+            previous = self._snapshots.get(key)
+            if previous is not None and previous != snapshot:
+                self.mark_dirty(key)
+            self._snapshots[key] = snapshot
+
+    def _poll(self):
+        while True:
+            time.sleep(self.interval)
+            try:
+                self.check()
+            except Exception:
+                logging.exception("Asset watcher failed")
+
+
+IN_MODIFY = 0x00000002
+IN_ATTRIB = 0x00000004
+IN_CLOSE_WRITE = 0x00000008
+IN_MOVED_FROM = 0x00000040
+IN_MOVED_TO = 0x00000080
+IN_CREATE = 0x00000100
+IN_DELETE = 0x00000200
+IN_DELETE_SELF = 0x00000400
+IN_MOVE_SELF = 0x00000800
+IN_Q_OVERFLOW = 0x00004000
+IN_ISDIR = 0x40000000
+
+WATCH_MASK = (
+    IN_MODIFY | IN_ATTRIB | IN_CLOSE_WRITE | IN_MOVED_FROM | IN_MOVED_TO |
+    IN_CREATE | IN_DELETE | IN_DELETE_SELF | IN_MOVE_SELF
+)
+
+EVENT_HEADER = struct.Struct("iIII")
+
+
+class InotifyWatcher(Watcher):
+    """ Uses Linux's inotify to be told about changes, so there's no scanning at all. """
+
+    def __init__(self):
+        super(InotifyWatcher, self).__init__()
+        self._fd = _libc.inotify_init()
+        if self._fd < 0:
+            raise OSError(ctypes.get_errno(), "inotify_init failed")
+
+        self._directories = {} #watch descriptor: directory
+        self._recursive = set() #directories which are watched recursively
+
+        thread = threading.Thread(target=self._read_events)
+        thread.daemon = True
+        thread.start()
+
+    def watch(self, key, paths):
+        super(InotifyWatcher, self).watch(key, paths)
+        with self._lock:
+            for directory, recursive in paths:
+                if recursive:
+                    self._recursive.add(directory)
+                    for root, dirnames, filenames in os.walk(directory, followlinks=True):
+                        self._add_watch(root)
+                else:
+                    self._add_watch(directory)
+
+    def _add_watch(self, directory):
+        """ Must be called with the lock held, as the reader thread uses the watches too. """
+        if directory in self._directories.values():
+            return
+
+        path = directory
+        if isinstance(path, unicode):
+            path = path.encode(sys.getfilesystemencoding() or "utf-8")
+
+        wd = _libc.inotify_add_watch(self._fd, path, WATCH_MASK)
+        if wd < 0:
+            logging.warn("Unable to watch %s: %s", directory, os.strerror(ctypes.get_errno()))
+            return
+        self._directories[wd] = directory
+
+    def _in_recursive_watch(self, path):
+        return any(
+            path.startswith(directory.rstrip(os.sep) + os.sep) for directory in self._recursive
+        )
+
+    def _read_events(self):
+        while True:
+            try:
+                data = os.read(self._fd, 64 * 1024)
+            except OSError, e:
+                if e.errno == errno.EINTR:
+                    continue
+                raise
+
+            offset = 0
+            while offset < len(data):
+                wd, mask, cookie, length = EVENT_HEADER.unpack_from(data, offset)
+                name = data[offset + EVENT_HEADER.size:offset + EVENT_HEADER.size + length].rstrip("\0")
+                offset += EVENT_HEADER.size + length
+
+                if mask & IN_Q_OVERFLOW:
+                    #We've missed events, so anything could have changed
+                    with self._lock:
+                        keys = self._paths.keys()
+                    for key in keys:
+                        self.mark_dirty(key)
+                    continue
+
+                with self._lock:
+                    directory = self._directories.get(wd)
+                    if directory is None:
+                        continue
+
+                    path = os.path.join(directory, name) if name else directory
+                    if mask & IN_ISDIR and mask & (IN_CREATE | IN_MOVED_TO) and self._in_recursive_watch(path):
+                        self._add_watch(path)
+
+                for key in self._keys_watching(directory):
+                    self.mark_dirty(key)
+
+
+_watcher = None
+_watcher_lock = threading.Lock()
+
+def get_watcher():
+    """ Returns the watcher configured by ASSET_WATCHER, or None if watching is switched off.
+        ASSET_WATCHER can be "inotify", "polling" or "auto" (inotify if available).
+    """
+    global _watcher
+    from django.conf import settings
+
+    backend = getattr(settings, "ASSET_WATCHER", None)
+    if not backend:
+        return None
+
+    with _watcher_lock:
+        if _watcher is None:
+            if backend == "inotify" or (backend == "auto" and HAVE_INOTIFY):
+                _watcher = InotifyWatcher()
+            else:
+                _watcher = PollingWatcher(getattr(settings, "ASSET_WATCHER_INTERVAL", 1))
+        return _watcher
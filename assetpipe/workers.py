@@ -0,0 +1,254 @@
+""" Long-lived compiler processes, so that JVM startup is only paid once rather than per file.
+
+    A worker is any command which reads requests from stdin and writes responses to stdout
+    using the framing below, one request at a time, until stdin is closed. A frame is the
+    length of the payload in bytes as ASCII digits, a newline, then the payload itself.
+
+        request:  frame(JSON list of command line arguments) frame(input)
+        response: frame(exit status as ASCII digits) frame(output) frame(errors)
+
+    The arguments are the ones which would have been passed to the compiler on the command line
+    (e.g. ["--type", "css"]), so a worker just needs to wrap the compiler's main entry point.
+    serve() implements the worker side of the protocol for workers written in Python, and
+    java/AssetpipeWorker.java (see JAVA_WORKER_SOURCE) for compilers which run on the JVM.
+"""
+import os
+import sys
+import time
+import Queue
+import atexit
+import logging
+import threading
+
+try:
+    import json
+except ImportError:
+    from django.utils import simplejson as json
+
+from .base import CLOSE_FDS
+
+
+DEFAULT_IDLE_TIMEOUT = 300 #seconds
+
+#A worker for any compiler with a Java main class, run it with e.g.
+#["java", "-cp", "yuicompressor.jar", JAVA_WORKER_SOURCE, "com.yahoo.platform.yui.compressor.YUICompressor"]
+JAVA_WORKER_SOURCE = os.path.join(os.path.dirname(os.path.abspath(__file__)), "java", "AssetpipeWorker.java")
+
+
+class WorkerCrashed(Exception):
+    pass
+
+
+def write_frame(stream, payload):
+    stream.write("%d\n" % len(payload))
+    stream.write(payload)
+
+
+def read_frame(stream):
+    """ Reads a single frame, raises EOFError if the stream is closed before a full frame was read. """
+    header = stream.readline()
+    if not header.endswith("\n"):
+        raise EOFError()
+
+    length = int(header)
+    payload = stream.read(length)
+    if len(payload) != length:
+        raise EOFError()
+    return payload
+
+
+def serve(handler, stdin=None, stdout=None):
+    """ Runs the worker side of the protocol. handler(args, input) must return a tuple
+        of (exit_status, output, errors). Returns when stdin is closed.
+    """
+    stdin = stdin or sys.stdin
+    stdout = stdout or sys.stdout
+
+    while True:
+        try:
+            args = json.loads(read_frame(stdin))
+            data = read_frame(stdin)
+        except EOFError:
+            return
+
+        status, output, errors = handler(args, data)
+        write_frame(stdout, str(status))
+        write_frame(stdout, output)
+        write_frame(stdout, errors)
+        stdout.flush()
+
+
+class Worker(object):
+    """ A single worker process, started on first use. """
+
+    def __init__(self, command):
+        self.command = command
+        self.process = None
+        self.last_used = time.time()
+
+    def is_alive(self):
+        return self.process is not None and self.process.poll() is None
+
+    def start(self):
+        from subprocess import Popen, PIPE
+
+        logging.info("Starting compiler worker: %s", " ".join(self.command))
+        self.process = Popen(
+            self.command, stdin=PIPE, stdout=PIPE,
+            bufsize=-1, close_fds=CLOSE_FDS
+        )
+
+    def stop(self):
+        if self.process is None:
+            return
+
+        process, self.process = self.process, None
+        try:
+            process.stdin.close()
+        except IOError:
+            pass
+
+        #Give the worker a moment to exit cleanly before killing it
+        for i in xrange(20):
+            if process.poll() is not None:
+                break
+            time.sleep(0.05)
+        else:
+            try:
+                process.kill()
+            except OSError:
+                pass
+            process.wait()
+
+    def call(self, args, data):
+        """ Returns (exit_status, output, errors), raises WorkerCrashed if the
+            worker process dies before responding.
+        """
+        if not self.is_alive():
+            self.start()
+
+        self.last_used = time.time()
+        try:
+            write_frame(self.process.stdin, json.dumps(args))
+            write_frame(self.process.stdin, data)
+            self.process.stdin.flush()
+
+            status = int(read_frame(self.process.stdout))
+            output = read_frame(self.process.stdout)
+            errors = read_frame(self.process.stdout)
+        except (IOError, EOFError, ValueError), e:
+            self.stop()
+            raise WorkerCrashed("Compiler worker %s died: %r" % (" ".join(self.command), e))
+        finally:
+            self.last_used = time.time()
+
+        return status, output, errors
+
+
+class WorkerPool(object):
+    """ Up to `size` workers running the same command. Workers are started when they are needed,
+        restarted if they crash, and stopped after idle_timeout seconds of not being used.
+    """
+
+    def __init__(self, command, size=1, idle_timeout=DEFAULT_IDLE_TIMEOUT):
+        self.command = list(command)
+        self.idle_timeout = idle_timeout
+        self._workers = [ Worker(self.command) for i in xrange(max(1, size)) ]
+        self._idle = Queue.Queue()
+        for worker in self._workers:
+            self._idle.put(worker)
+
+        self._lock = threading.Lock()
+        self._reaper = None
+
+    def call(self, args, data):
+        """ Sends a request to the next free worker. If the worker crashes it is restarted
+            and the request retried once, so that one bad JVM doesn't fail the build.
+        """
+        worker = self._idle.get()
+        try:
+            try:
+                return worker.call(args, data)
+            except WorkerCrashed, e:
+                logging.warn("%s, restarting it", e)
+                return worker.call(args, data)
+        finally:
+            self._idle.put(worker)
+            self._start_reaper()
+
+    def shutdown(self):
+        for worker in self._workers:
+            worker.stop()
+
+    def _start_reaper(self):
+        if not self.idle_timeout:
+            return
+
+        with self._lock:
+            if self._reaper is not None and self._reaper.is_alive():
+                return
+            self._reaper = threading.Thread(target=self._reap)
+            self._reaper.daemon = True
+            self._reaper.start()
+
+    def _reap(self):
+        """ Stops idle workers, exits once they have all been stopped. """
+        while True:
+            time.sleep(min(self.idle_timeout, 5))
+
+            running = 0
+            for worker in self._workers:
+                if not worker.is_alive():
+                    continue
+
+                #Only stop workers which aren't in the middle of a request
+                if time.time() - worker.last_used > self.idle_timeout and self._take_idle(worker):
+                    try:
+                        logging.info("Stopping idle compiler worker: %s", " ".join(self.command))
+                        worker.stop()
+                    finally:
+                        self._idle.put(worker)
+                else:
+                    running += 1
+
+            if not running:
+                with self._lock:
+                    #A worker may have been started since we checked
+                    if any(worker.is_alive() for worker in self._workers):
+                        continue
+                    self._reaper = None
+                return
+
+    def _take_idle(self, worker):
+        """ Removes worker from the idle queue if it's there. """
+        with self._idle.mutex:
+            if worker in self._idle.queue:
+                self._idle.queue.remove(worker)
+                return True
+        return False
+
+
+_pools = {}
+_pools_lock = threading.Lock()
+
+def get_worker_pool(command):
+    """ Returns the shared WorkerPool for command, configured by the ASSET_COMPILER_WORKER_* settings.
+        Pools (and their processes) live for the lifetime of the Python process, so warm workers are
+        reused across pipeline runs.
+    """
+    from django.conf import settings
+
+    size = getattr(settings, "ASSET_COMPILER_WORKER_POOL_SIZE", 1)
+    idle_timeout = getattr(settings, "ASSET_COMPILER_WORKER_IDLE_TIMEOUT", DEFAULT_IDLE_TIMEOUT)
+
+    key = (tuple(command), size, idle_timeout)
+    with _pools_lock:
+        if key not in _pools:
+            _pools[key] = WorkerPool(command, size, idle_timeout)
+        return _pools[key]
+
+
+@atexit.register
+def shutdown_worker_pools():
+    for pool in _pools.values():
+        pool.shutdown()
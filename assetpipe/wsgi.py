@@ -0,0 +1,58 @@
+""" WSGI middleware which lets the server send the files served by assetpipe itself,
+    using wsgi.file_wrapper (which servers such as gunicorn implement with sendfile).
+
+    In your wsgi.py:
+
+        from assetpipe.wsgi import FileWrapperMiddleware
+        application = FileWrapperMiddleware(get_wsgi_application())
+"""
+from .buffers import CHUNK_SIZE
+
+
+class _ResponseFile(object):
+    """ Passes the file to the server, and closes the Django response along with it,
+        as the server would have done if it had been given the response.
+    """
+
+    def __init__(self, f, response):
+        self.file = f
+        self.response = response
+        if hasattr(f, "fileno"):
+            self.fileno = f.fileno
+
+    def read(self, size=-1):
+        return self.file.read(size)
+
+    def close(self):
+        try:
+            self.file.close()
+        finally:
+            self.response.close()
+
+
+def _is_unchanged(response):
+    """ Returns True if the response still has the content and encoding that file_response()
+        gave it, i.e. no middleware (such as GZipMiddleware) has rewritten it since. Anything
+        which rewrites the content either reads it or changes its length or encoding.
+    """
+    chunks = response.file_chunks
+    return (
+        not chunks.started and
+        response.get("Content-Length") == str(chunks.length) and
+        response.get("Content-Encoding") == response.file_encoding
+    )
+
+
+class FileWrapperMiddleware(object):
+    def __init__(self, application):
+        self.application = application
+
+    def __call__(self, environ, start_response):
+        response = self.application(environ, start_response)
+
+        f = getattr(response, "file_to_stream", None)
+        file_wrapper = environ.get("wsgi.file_wrapper")
+        if f is None or file_wrapper is None or not _is_unchanged(response):
+            return response
+
+        return file_wrapper(_ResponseFile(f, response), CHUNK_SIZE)
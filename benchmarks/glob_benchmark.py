@@ -0,0 +1,95 @@
+""" Compares assetpipe.glob with the implementation it replaced, on a generated tree.
+
+    python benchmarks/glob_benchmark.py [number_of_files]
+"""
+import os
+import re
+import sys
+import time
+import shutil
+import tempfile
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+from assetpipe.glob import glob, glob_many
+
+
+def legacy_glob(pathname):
+    """ The original implementation, including its bugs. """
+    results = []
+
+    root = os.path.dirname(pathname).split("**")[0]
+    regex = re.escape(pathname)
+
+    regex = regex.replace("\\*\\*\\/\\*", "([a-zA-Z0-9_-|\\/|\s]+)")
+    regex = regex.replace("\\*\\*", "([a-zA-Z0-9_-|\\/|\s]+)")
+    regex = regex.replace("\\*", "([a-zA-Z0-9_-]+)")
+
+    for root, dirnames, filenames in os.walk(top=root, followlinks=True):
+        for f in filenames:
+            full_path = os.path.join(root, f)
+            if re.match(regex, full_path):
+                results.append(full_path)
+
+    return results
+
+
+def build_tree(root, count):
+    """ Builds a tree of roughly count files, spread over apps with static/scss,
+        static/js and a large vendor directory.
+    """
+    created = 0
+    app = 0
+    while created < count:
+        for kind, ext in (("scss", "scss"), ("js", "js"), ("vendor", "js"), ("img", "png")):
+            directory = os.path.join(root, "app%d" % app, "static", kind, "sub%d" % (app % 7))
+            os.makedirs(directory)
+            for i in xrange(125):
+                open(os.path.join(directory, "file%d.%s" % (i, ext)), "w").close()
+                created += 1
+        app += 1
+
+
+def timed(func, repeat=3):
+    best = None
+    for i in xrange(repeat):
+        start = time.time()
+        result = func()
+        elapsed = time.time() - start
+        best = elapsed if best is None else min(best, elapsed)
+    return best, result
+
+
+def main():
+    count = int(sys.argv[1]) if len(sys.argv) > 1 else 50000
+    root = tempfile.mkdtemp()
+    try:
+        build_tree(root, count)
+
+        patterns = [
+            os.path.join(root, "app1", "static", "scss", "**", "*.scss"),
+            os.path.join(root, "**", "scss", "**", "*.scss"),
+            os.path.join(root, "**", "js", "*", "*.js"),
+            os.path.join(root, "*", "static", "scss", "sub1", "*.scss"),
+            os.path.join(root, "app3", "static", "js", "sub3", "file1.js"),
+        ]
+
+        print "%d files" % count
+        total_legacy = total_new = 0
+        for pattern in patterns:
+            legacy_time, legacy_result = timed(lambda: legacy_glob(pattern))
+            new_time, new_result = timed(lambda: glob(pattern))
+            total_legacy += legacy_time
+            total_new += new_time
+            print "%-50s legacy %7.3fs (%5d files)  new %7.3fs (%5d files)" % (
+                pattern[len(root):], legacy_time, len(legacy_result), new_time, len(new_result)
+            )
+
+        shared_time, shared = timed(lambda: glob_many(patterns))
+        print "%-50s legacy %7.3fs  new %7.3fs  glob_many %7.3fs" % ("all patterns", total_legacy, total_new, shared_time)
+    finally:
+        shutil.rmtree(root)
+
+
+if __name__ == '__main__':
+    main()
@@ -8,12 +8,17 @@ URL = "https://github.com/potatolondon/assetpipe"
 LONG_DESCRIPTION = open(os.path.join(os.path.dirname(__file__), 'README.md')).read()
 AUTHOR = 'Potato London Ltd.'
 
-EXTRAS = {}
+EXTRAS = {
+    # Faster directory walking for the globbing of inputs and dependencies on Python 2
+    'scandir': ['scandir'],
+}
 
 setup(
     name=NAME,
     version='0.8.0',
     packages=PACKAGES,
+    # the worker for compilers which run on the JVM, see assetpipe/workers.py
+    package_data={'assetpipe': ['java/*.java']},
     # metadata for upload to PyPI
     author=AUTHOR,
     description=DESCRIPTION,